@@ -0,0 +1,167 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import globals
+import fast_computation
+import image_processing
+from image_processing import image_processor
+from data_files import load_image, load_positions
+
+
+def paint_positions(image, positions, colors):
+    # the same markers as painter_widget.paint
+    image = image.copy()
+    for pos in range(len(positions)):
+        center = (int(positions[pos][1]), int(positions[pos][0]))
+        cv2.circle(image, center, 10, (255, 255, 255), -1)
+        cv2.circle(image, center, 8, (0, 0, 0), -1)
+        cv2.circle(image, center, 6, tuple(int(value) for value in colors[pos]), -1)
+    return image
+
+
+def save_image(file_name, image):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    cv2.imwrite(file_name, image)
+
+
+def find_pairs(image_files, positions_files, all_pairs):
+    """By default each image is paired with the positions files whose name is the name of the
+    image, or starts with it followed by '_' (img1.png with img1_grid.csv, but not with
+    img10_grid.csv). With all_pairs, each image is paired with all the positions files
+    """
+    pairs = []
+    for image_file in image_files:
+        image_name = os.path.splitext(os.path.basename(image_file))[0]
+        for positions_file in positions_files:
+            positions_name = os.path.splitext(os.path.basename(positions_file))[0]
+            if all_pairs or positions_name == image_name or positions_name.startswith(image_name + '_'):
+                pairs.append((image_file, positions_file))
+    return pairs
+
+
+def list_files(directory, extensions):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if os.path.splitext(name)[1].lower() in extensions)
+
+
+def process_pair(image_file, positions_file, args):
+    """Computes and saves the processed image, the MHD image and the differences for one
+    image and one positions file. Returns a row of the report
+    """
+    fast_computation.set_num_threads(args.threads)
+
+    start = time.perf_counter()
+    image_rgb = load_image(image_file, args.width)
+    positions = load_positions(positions_file, image_rgb.shape[1], image_rgb.shape[0])
+
+    processor = image_processor()
+    processor.color_model_smooth = args.smooth
+    processor.color_model = args.color_model
+    processor.compute_kmeans_value = args.kmeans
+    processor.kmeans_num_clusters_value = args.clusters
+    image_processed = processor.compute_processed_image(image_rgb)
+    colors = np.array(image_processing.compute_colors(image_processed, positions), dtype=np.uint8).reshape((-1, 3))
+
+    image_name = os.path.splitext(os.path.basename(image_file))[0]
+    positions_name = os.path.splitext(os.path.basename(positions_file))[0]
+    file_name_without_ext = os.path.join(args.output, image_name + '_' + positions_name)
+
+    save_image(file_name_without_ext + '_ori.png', paint_positions(image_processed, positions, colors))
+
+    percentage = ''
+    if len(positions) > 0:
+        labels, distances, image_mhd, differences, percentage = fast_computation.compute_mhd_differences(positions, colors, image_processed, args.parameters, args.threshold, globals.MHD_USE_INDEX, globals.MHD_TILE_SIZE)
+        save_image(file_name_without_ext + '_mhd.png', image_mhd)
+        save_image(file_name_without_ext + '_dif.png', differences)
+        if args.labels:
+            # the index of the nearest sample of each pixel and the squared distance to it
+            np.save(file_name_without_ext + '_labels.npy', labels)
+            np.save(file_name_without_ext + '_distances.npy', distances)
+        if args.curve:
+            # the percentage of differences for all the thresholds, from one pass over the image
+            percentages = fast_computation.compute_threshold_curve(fast_computation.compute_distance_counts(fast_computation.compute_color_distances(image_processed, image_mhd)))
+            with open(file_name_without_ext + '_curve.csv', mode='w', encoding='utf-8') as file:
+                file.write('Threshold;Differences\n')
+                for threshold in range(len(percentages)):
+                    file.write(str(threshold) + ';' + str(percentages[threshold]) + '\n')
+        percentage = '{:.4f}'.format(percentage)
+
+    print('{} {}: {} positions, {:.2f} s'.format(image_name, positions_name, len(positions), time.perf_counter() - start))
+    return [os.path.basename(image_file), os.path.basename(positions_file), str(len(positions)), percentage, '']
+
+
+def run_pair(image_file, positions_file, args):
+    """Calls process_pair. An error is returned as a row of the report, so the other pairs
+    are computed and the report is saved
+    """
+    try:
+        return process_pair(image_file, positions_file, args)
+    except Exception as error:
+        message = '{}: {}'.format(type(error).__name__, error).replace(';', ',').replace('\n', ' ')
+        print('{} {}: {}'.format(os.path.basename(image_file), os.path.basename(positions_file), message))
+        return [os.path.basename(image_file), os.path.basename(positions_file), '', '', message]
+
+
+def parse_parameters(text):
+    # the MHD parameters R, G, B, X, Y as a mask of 0 and 1, for example 11100
+    if len(text) != 5 or any(character not in '01' for character in text):
+        raise argparse.ArgumentTypeError('the parameters must be 5 digits 0 or 1, for example 11111')
+    if '1' not in text:
+        # as in the interface, at least one parameter is used
+        raise argparse.ArgumentTypeError('at least one parameter must be 1')
+    return [character == '1' for character in text]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Computes the MHD images and the differences for many images and positions files without the interface')
+    parser.add_argument('images', help='folder with the images (png, jpg)')
+    parser.add_argument('positions', help='folder with the positions files (csv)')
+    parser.add_argument('output', help='folder where the images and the report are saved')
+    parser.add_argument('--width', type=int, default=globals.CANVAS_WIDTH, help='the images are resized to this width, as in the interface')
+    parser.add_argument('--smooth', type=int, default=1, choices=globals.COLOR_SMOOTH_KERNEL_SIZE)
+    parser.add_argument('--color-model', default='RGB', choices=globals.COLOR_MODELS)
+    parser.add_argument('--kmeans', action='store_true')
+    parser.add_argument('--clusters', type=int, default=globals.KMEANS_NUM_CLUSTERS)
+    parser.add_argument('--threshold', type=int, default=0, help='threshold of the differences (0-100)')
+    parser.add_argument('--parameters', type=parse_parameters, default=globals.MHD_PARAMETERS, help='mask of the MHD parameters R, G, B, X, Y, for example 11111')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='pairs computed at the same time')
+    parser.add_argument('--threads', type=int, default=1, help='threads of the kernels in each process')
+    parser.add_argument('--labels', action='store_true', help='also save the label map and the distances as .npy files')
+    parser.add_argument('--curve', action='store_true', help='also save the percentage of differences for all the thresholds')
+    parser.add_argument('--all-pairs', action='store_true', help='use all the positions files with all the images')
+    args = parser.parse_args()
+
+    image_files = list_files(args.images, ('.png', '.jpg', '.jpeg'))
+    positions_files = list_files(args.positions, ('.csv',))
+    pairs = find_pairs(image_files, positions_files, args.all_pairs)
+    if not pairs:
+        print('There are no pairs of image and positions file')
+        return
+
+    os.makedirs(args.output, exist_ok=True)
+
+    start = time.perf_counter()
+    rows = []
+    if args.processes > 1:
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [executor.submit(run_pair, image_file, positions_file, args) for image_file, positions_file in pairs]
+            rows = [future.result() for future in futures]
+    else:
+        for image_file, positions_file in pairs:
+            rows.append(run_pair(image_file, positions_file, args))
+
+    with open(os.path.join(args.output, 'report.csv'), mode='w', encoding='utf-8') as file:
+        file.write('Image;Positions;Num_positions;Differences;Error\n')
+        for row in rows:
+            file.write(';'.join(row) + '\n')
+
+    print('{} pairs in {:.2f} s'.format(len(pairs), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
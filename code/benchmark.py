@@ -0,0 +1,276 @@
+import argparse
+import json
+import math
+import time
+
+import cv2
+import numba
+import numpy as np
+from numba import jit
+
+import globals
+import fast_computation
+from image_processing import image_processor
+from data_files import load_image, load_positions
+
+
+@jit
+def legacy_compute_mhd(positions, colors, image, mhd_parameters_values):
+    # the kernel before the features were precomputed, kept as reference
+    result = np.zeros(image.shape, dtype=np.uint8)
+
+    width = image.shape[1]-1
+    height = image.shape[0]-1
+
+    parameters = np.zeros(5)
+    for x in range(image.shape[1]):
+        parameters[3] = x/width
+        for y in range(image.shape[0]):
+            parameters[4] = y/height
+
+            color = image[y, x]
+
+            parameters[0] = float(color[0]) / 255.0
+            parameters[1] = float(color[1]) / 255.0
+            parameters[2] = float(color[2]) / 255.0
+
+            min = 1e10
+            pos_min = 0
+            parameters_know = np.zeros(5)
+            for pos in range(len(positions)):
+                parameters_know[0] = float(colors[pos][0]) / 255.0
+                parameters_know[1] = float(colors[pos][1]) / 255.0
+                parameters_know[2] = float(colors[pos][2]) / 255.0
+                parameters_know[3] = positions[pos][1]/width
+                parameters_know[4] = positions[pos][0]/height
+
+                sum = 0.0
+                for i in range(5):
+                    if mhd_parameters_values[i]:
+                        sum = sum + (parameters[i]-parameters_know[i])**2
+
+                distance = math.sqrt(sum)
+                if distance < min:
+                    min = distance
+                    pos_min = pos
+
+            result[y, x] = colors[pos_min]
+
+    return result
+
+
+def measure(function, repetitions):
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def measure_first(function):
+    # the first call includes the compilation of the kernels
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def disable_numba_cache():
+    """The kernels of fast_computation are compiled with cache=True, so the first call usually
+    loads them from the disk. Without the cache the compile phase measures the compilation
+    """
+    from numba.core.caching import NullCache
+    from numba.core.registry import CPUDispatcher
+
+    for value in vars(fast_computation).values():
+        if isinstance(value, CPUDispatcher):
+            value._cache = NullCache()
+
+
+def get_cache_hits():
+    # number of kernels loaded from the cache of numba
+    from numba.core.registry import CPUDispatcher
+
+    return sum(sum(value.stats.cache_hits.values()) for value in vars(fast_computation).values() if isinstance(value, CPUDispatcher))
+
+
+def random_positions(image, num_samples, random_generator):
+    positions = np.stack((random_generator.integers(0, image.shape[0], num_samples), random_generator.integers(0, image.shape[1], num_samples)), axis=1)
+    return positions, image[positions[:, 0], positions[:, 1]]
+
+
+def parse_mask(text):
+    return [character == '1' for character in text]
+
+
+def compare(args):
+    """Compares the original kernel with the brute force and the index kernels"""
+    image = load_image(args.image, args.width)
+    positions = load_positions(args.positions, image.shape[1], image.shape[0])
+    colors = image[positions[:, 0], positions[:, 1]]
+    mhd_parameters_values = globals.MHD_PARAMETERS
+
+    print('Image', image.shape[1], 'x', image.shape[0], 'with', len(positions), 'positions')
+
+    # compile the kernels before measuring
+    small_image = image[:8, :8].copy()
+    small_positions = np.array([[0, 0], [7, 7]])
+    small_colors = small_image[small_positions[:, 0], small_positions[:, 1]]
+    legacy_compute_mhd(small_positions, small_colors, small_image, mhd_parameters_values)
+    fast_computation.compute_mhd(small_positions, small_colors, small_image, mhd_parameters_values, False)
+    fast_computation.compute_mhd(small_positions, small_colors, small_image, mhd_parameters_values, True)
+
+    time_legacy, result_legacy = measure(lambda: legacy_compute_mhd(positions, colors, image, mhd_parameters_values), args.repetitions)
+    time_brute_force, result_brute_force = measure(lambda: fast_computation.compute_mhd(positions, colors, image, mhd_parameters_values, False), args.repetitions)
+    time_index, result_index = measure(lambda: fast_computation.compute_mhd(positions, colors, image, mhd_parameters_values, True), args.repetitions)
+
+    print('Legacy      {:8.3f} s'.format(time_legacy))
+    print('Brute force {:8.3f} s  x{:.1f}'.format(time_brute_force, time_legacy / time_brute_force))
+    print('Index       {:8.3f} s  x{:.1f}'.format(time_index, time_legacy / time_index))
+    print('Pixels different from legacy:', np.count_nonzero(np.any(result_legacy != result_index, axis=2)))
+    print('Pixels different between brute force and index:', np.count_nonzero(np.any(result_brute_force != result_index, axis=2)))
+
+
+# number of calls of compute_mhd_position in each measure
+ONE_POSITION_QUERIES = 100
+
+
+def get_kernels(args):
+    """Returns the kernels measured, as (name, function(image, positions, colors, mhd_parameters_values)).
+    The preprocessing does not depend on the positions, so it is measured once for each size
+    """
+    kernels = [('compute_mhd', lambda image, positions, colors, mhd_parameters_values: fast_computation.compute_mhd(positions, colors, image, mhd_parameters_values, True, globals.MHD_TILE_SIZE))]
+    if args.brute_force:
+        kernels.append(('compute_mhd_brute_force', lambda image, positions, colors, mhd_parameters_values: fast_computation.compute_mhd(positions, colors, image, mhd_parameters_values, False, globals.MHD_TILE_SIZE)))
+
+    def one_position(image, positions, colors, mhd_parameters_values):
+        # a drag in minimum mode: the query is built when it starts, and each position uses the
+        # previous result as initial bound. The time is divided by the number of queries
+        query = fast_computation.build_mhd_query(positions, colors, image.shape, mhd_parameters_values)
+        pos_min = 0
+        for pos in range(ONE_POSITION_QUERIES):
+            pos_min = fast_computation.compute_mhd_position(query, image, (pos * 3) % image.shape[1], (pos * 2) % image.shape[0], pos_min)
+    kernels.append(('compute_mhd_position', one_position))
+
+    kernels.append(('compute_differences', lambda image, positions, colors, mhd_parameters_values: fast_computation.compute_differences(image, image[::-1].copy(), 10)))
+    return kernels
+
+
+def create_processor(**values):
+    processor = image_processor()
+    for name, value in values.items():
+        setattr(processor, name, value)
+    return processor
+
+
+def get_preprocessing():
+    """Returns the configurations of the preprocessing measured, as (name, function that
+    returns an image_processor). A new processor is used in each measure, so k-means does not
+    start from the centers of the previous one
+    """
+    return [('preprocessing_blur', lambda: create_processor(color_model_smooth=5)),
+            ('preprocessing_hls', lambda: create_processor(color_model='HLS')),
+            ('preprocessing_kmeans', lambda: create_processor(compute_kmeans_value=True))]
+
+
+def run_suite(args):
+    """Measures the kernels over a grid of sizes, numbers of samples and masks of parameters.
+    The time of the first call with a small image, which includes the compilation, is saved
+    apart from the steady time, which is the minimum of the repetitions. The cache of numba is
+    not used in the first call unless --numba-cache is given, and the kernels loaded from it
+    are saved in cache_hits
+    """
+    image_original = load_image(args.image, args.width)
+    sizes = [int(value) for value in args.sizes.split(',')]
+    samples = [int(value) for value in args.samples.split(',')]
+    masks = args.masks.split(',')
+    kernels = get_kernels(args)
+    preprocessing = get_preprocessing()
+    random_generator = np.random.default_rng(0)
+
+    rows = []
+
+    # compilation
+    if not args.numba_cache:
+        disable_numba_cache()
+    small_image = cv2.resize(image_original, (16, 16))
+    small_positions, small_colors = random_positions(small_image, 2, random_generator)
+    for name, function in kernels:
+        cache_hits = get_cache_hits()
+        seconds = measure_first(lambda: function(small_image, small_positions, small_colors, parse_mask(masks[0])))
+        rows.append({'kernel': name, 'phase': 'compile', 'width': 16, 'height': 16, 'samples': 2, 'parameters': masks[0], 'seconds': seconds,
+                     'cache_hits': get_cache_hits() - cache_hits})
+        print('{:28} compile {:8.3f} s'.format(name, seconds))
+    for name, create in preprocessing:
+        cache_hits = get_cache_hits()
+        seconds = measure_first(lambda: create().compute_processed_image(small_image))
+        rows.append({'kernel': name, 'phase': 'compile', 'width': 16, 'height': 16, 'samples': 0, 'parameters': '', 'seconds': seconds,
+                     'cache_hits': get_cache_hits() - cache_hits})
+        print('{:28} compile {:8.3f} s'.format(name, seconds))
+
+    # steady
+    for width in sizes:
+        height = int(width * image_original.shape[0] / image_original.shape[1])
+        image = cv2.resize(image_original, (width, height))
+
+        for name, create in preprocessing:
+            seconds, result = measure(lambda: create().compute_processed_image(image), args.repetitions)
+            rows.append({'kernel': name, 'phase': 'steady', 'width': width, 'height': height, 'samples': 0, 'parameters': '', 'seconds': seconds})
+            print('{:28} {:5} x {:5} {:8.3f} s'.format(name, width, height, seconds))
+
+        for num_samples in samples:
+            positions, colors = random_positions(image, num_samples, random_generator)
+            for mask in masks:
+                mhd_parameters_values = parse_mask(mask)
+                for name, function in kernels:
+                    if name == 'compute_differences' and (num_samples != samples[0] or mask != masks[0]):
+                        # it does not depend on the samples nor the parameters
+                        continue
+                    seconds, result = measure(lambda: function(image, positions, colors, mhd_parameters_values), args.repetitions)
+                    if name == 'compute_mhd_position':
+                        seconds = seconds / ONE_POSITION_QUERIES
+                    rows.append({'kernel': name, 'phase': 'steady', 'width': width, 'height': height, 'samples': num_samples, 'parameters': mask, 'seconds': seconds})
+                    print('{:28} {:5} x {:5} {:6} samples {} {:10.5f} s'.format(name, width, height, num_samples, mask, seconds))
+
+    information = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'numba': numba.__version__, 'opencv': cv2.__version__,
+                   'numpy': np.__version__, 'threads': fast_computation.get_max_threads() if args.threads is None else args.threads,
+                   'tile_size': globals.MHD_TILE_SIZE, 'numba_cache': args.numba_cache, 'image': args.image, 'repetitions': args.repetitions, 'results': rows}
+
+    with open(args.output + '.json', mode='w', encoding='utf-8') as file:
+        json.dump(information, file, indent=1)
+
+    with open(args.output + '.csv', mode='w', encoding='utf-8') as file:
+        file.write('Kernel;Phase;Width;Height;Samples;Parameters;Seconds\n')
+        for row in rows:
+            file.write('{};{};{};{};{};{};{:.6f}\n'.format(row['kernel'], row['phase'], row['width'], row['height'], row['samples'], row['parameters'], row['seconds']))
+
+    print('Results saved in', args.output + '.json', 'and', args.output + '.csv')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the kernels of fast_computation and the preprocessing')
+    parser.add_argument('--image', default='data/vis_visible.jpg')
+    parser.add_argument('--positions', default='data/transfiguracion_grid.csv')
+    parser.add_argument('--width', type=int, default=1000, help='width of the image in the comparison')
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument('--compare', action='store_true', help='only compare the original MHD kernel with the new ones')
+    parser.add_argument('--sizes', default='500,1000,2000,' + str(globals.CANVAS_MAXIMUM), help='widths of the images')
+    parser.add_argument('--samples', default='10,100,1000', help='numbers of samples')
+    parser.add_argument('--masks', default='11111,11100,00011', help='masks of the MHD parameters R, G, B, X, Y')
+    parser.add_argument('--brute-force', action='store_true', help='also measure the brute force MHD kernel')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--numba-cache', action='store_true', help='use the cache of numba in the compile phase, so it measures loading the kernels')
+    parser.add_argument('--output', default='benchmark', help='name of the json and csv files, without extension')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        fast_computation.set_num_threads(args.threads)
+
+    if args.compare:
+        compare(args)
+    else:
+        run_suite(args)
+
+
+if __name__ == '__main__':
+    main()
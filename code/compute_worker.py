@@ -0,0 +1,56 @@
+import traceback
+
+from PySide6.QtCore import QObject, Signal
+
+
+class compute_signals(QObject):
+    """Signals used by the jobs to send information to the main window.
+    The first argument is always the generation of the job
+    """
+    stage = Signal(int, str)
+    preview = Signal(int)
+    finished = Signal(int)
+
+
+class compute_job:
+    """Runs function(job, *arguments) in a worker thread (see run).
+    A job is obsolete when its generation is not the current one; the function can check it
+    with is_cancelled() to stop early. The function returns a dict, which is empty if there
+    is no result, and it is kept in the attribute result
+    """
+
+    def __init__(self, generation, get_current_generation, signals, function, *arguments):
+        self.generation = generation
+        self.get_current_generation = get_current_generation
+        self.signals = signals
+        self.function = function
+        self.arguments = arguments
+        self.result = {}
+        self.preview = None
+
+    def is_cancelled(self):
+        return self.generation != self.get_current_generation()
+
+    def report(self, stage):
+        self.signals.stage.emit(self.generation, stage)
+
+    def report_preview(self, image, step):
+        """Sends a partial result, an image where each pixel is step x step pixels. Returns
+        False if the job is obsolete, so the computation can stop
+        """
+        if self.is_cancelled():
+            return False
+        self.preview = (image, step)
+        self.signals.preview.emit(self.generation)
+        return True
+
+    def run(self):
+        if not self.is_cancelled():
+            try:
+                self.result = self.function(self, *self.arguments)
+            except Exception:
+                traceback.print_exc()
+                self.result = {}
+
+        # only the generation is sent, the receiver reads the result from the job
+        self.signals.finished.emit(self.generation)
@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+
+def load_image(file_name, width):
+    # the same steps as MainWindow.load_image
+    image_bgr = cv2.imread(file_name)
+    if image_bgr is None:
+        raise ValueError('The image {} cannot be read'.format(file_name))
+    height = int(width * image_bgr.shape[0] / image_bgr.shape[1])
+    image_bgr = cv2.resize(image_bgr, (width, height))
+    return cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+
+
+def load_positions(file_name, width, height):
+    # the same steps as MainWindow.load_positions: read as x, y but added as y, x for numpy
+    positions = []
+    with open(file_name, mode='r', encoding='utf-8') as file:
+        lines = file.readlines()
+        for pos in range(1, len(lines)):
+            line = lines[pos].strip()
+            if line == '':
+                continue
+            tokens = line.split(';')
+            positions.append([int(float(tokens[2])*(height-1)), int(float(tokens[1])*(width-1))])
+    return np.array(positions, dtype=np.int64).reshape((-1, 2))
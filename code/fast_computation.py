@@ -1,96 +1,684 @@
 import math
+import time
 import numpy as np
-from numba import jit
+import numba
+from numba import jit, prange
 
+# the kernels are launched from a worker thread of the main window, and with the tbb layer
+# the program may not exit in that case, so the other layers are preferred
+numba.config.THREADING_LAYER_PRIORITY = ['omp', 'workqueue', 'tbb']
 
-@jit
-def compute_mhd_one_position(positions, colors, image, mhd_parameters_values, x , y):
-    width = image.shape[1]-1
-    height = image.shape[0]-1
+# number of threads used by the parallel kernels. numba keeps this value per calling
+# thread, so it is applied before each computation
+num_threads = numba.config.NUMBA_NUM_THREADS
 
-    parameters = np.zeros(5)
 
-    parameters[3] = x/width
-    parameters[4] = y/height
+def get_max_threads():
+    return numba.config.NUMBA_NUM_THREADS
 
-    color = image[y, x]
 
-    parameters[0] = float(color[0]) / 255.0
-    parameters[1] = float(color[1]) / 255.0
-    parameters[2] = float(color[2]) / 255.0
+def set_num_threads(value):
+    global num_threads
+    num_threads = max(1, min(value, numba.config.NUMBA_NUM_THREADS))
 
-    min = 1e10
-    pos_min = 0
-    parameters_know = np.zeros(5)
-    for pos in range(len(positions)):
-        parameters_know[0] = float(colors[pos][0]) / 255.0
-        parameters_know[1] = float(colors[pos][1]) / 255.0
-        parameters_know[2] = float(colors[pos][2]) / 255.0
-        parameters_know[3] = positions[pos][1]/width
-        parameters_know[4] = positions[pos][0]/height
 
-        sum = 0.0
-        for i in range(5):
-            if mhd_parameters_values[i]:
-                sum = sum + (parameters[i]-parameters_know[i])**2
 
-        distance = math.sqrt(sum)
-        if distance < min:
-            min = distance
+# normalized value of each color component
+COLOR_TABLE = (np.arange(256) / 255.0).astype(np.float32)
+
+
+def compute_features(positions, colors, image_shape, mhd_parameters_values):
+    """Returns the normalized samples as a contiguous N x k matrix, where k is the number
+    of enabled parameters, and the tables used to normalize the pixels in the same way
+    """
+    width = image_shape[1]-1
+    height = image_shape[0]-1
+
+    dims = np.array([i for i in range(5) if mhd_parameters_values[i]], dtype=np.int64)
+    x_table = (np.arange(image_shape[1]) / width).astype(np.float32)
+    y_table = (np.arange(image_shape[0]) / height).astype(np.float32)
+
+    all_features = np.zeros((len(positions), 5), dtype=np.float32)
+    all_features[:, 0:3] = COLOR_TABLE[colors[:, 0:3]]
+    all_features[:, 3] = positions[:, 1] / width
+    all_features[:, 4] = positions[:, 0] / height
+
+    return np.ascontiguousarray(all_features[:, dims]), dims, x_table, y_table
+
+
+@jit(nopython=True, cache=True)
+def compute_pixel_features(image, x, y, dims, x_table, y_table, parameters):
+    for j in range(dims.shape[0]):
+        dim = dims[j]
+        if dim < 3:
+            parameters[j] = COLOR_TABLE[image[y, x, dim]]
+        elif dim == 3:
+            parameters[j] = x_table[x]
+        else:
+            parameters[j] = y_table[y]
+
+
+@jit(nopython=True, cache=True)
+def squared_distance(features, pos, parameters):
+    # the square root is not needed to compare distances
+    sum = np.float32(0.0)
+    for j in range(parameters.shape[0]):
+        difference = parameters[j] - features[pos, j]
+        sum = sum + difference * difference
+    return sum
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def compute_mhd_labels_brute_force(features, dims, x_table, y_table, image, tile_size=16):
+    labels = np.zeros((image.shape[0], image.shape[1]), dtype=np.int32)
+    distances = np.zeros((image.shape[0], image.shape[1]), dtype=np.float32)
+
+    # each thread processes a tile of rows, in the same order the image is stored
+    num_tiles = (image.shape[0] + tile_size - 1) // tile_size
+    for tile in prange(num_tiles):
+        parameters = np.zeros(dims.shape[0], dtype=np.float32)
+        for y in range(tile * tile_size, min((tile + 1) * tile_size, image.shape[0])):
+            for x in range(image.shape[1]):
+                compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+
+                min_distance = np.float32(np.inf)
+                pos_min = 0
+                for pos in range(features.shape[0]):
+                    distance = squared_distance(features, pos, parameters)
+                    if distance < min_distance:
+                        min_distance = distance
+                        pos_min = pos
+
+                labels[y, x] = pos_min
+                distances[y, x] = min_distance
+
+    return labels, distances
+
+
+def build_mhd_index(features):
+    """Builds a kd-tree over the features.
+    Each node stores one sample; the arrays are indexed by node
+    """
+    num_samples = features.shape[0]
+
+    node_sample = np.zeros(num_samples, dtype=np.int64)
+    node_dim = np.zeros(num_samples, dtype=np.int64)
+    node_left = np.full(num_samples, -1, dtype=np.int64)
+    node_right = np.full(num_samples, -1, dtype=np.int64)
+
+    next_node = [0]
+
+    def build(samples):
+        if len(samples) == 0:
+            return -1
+
+        # split by the dimension with the largest spread
+        values = features[samples]
+        dim = np.argmax(values.max(axis=0) - values.min(axis=0))
+        samples = samples[np.lexsort((samples, features[samples, dim]))]
+        median = len(samples) // 2
+
+        node = next_node[0]
+        next_node[0] += 1
+        node_sample[node] = samples[median]
+        node_dim[node] = dim
+        node_left[node] = build(samples[:median])
+        node_right[node] = build(samples[median + 1:])
+        return node
+
+    build(np.arange(num_samples, dtype=np.int64))
+
+    return node_sample, node_dim, node_left, node_right
+
+
+@jit(nopython=True, cache=True)
+def query_mhd_index(features, node_sample, node_dim, node_left, node_right, parameters, pos_start, stack_node, stack_bound):
+    # the result is the same as the brute force search: the same distance computation and,
+    # in case of a tie, the lowest index. pos_start is used as the initial candidate
+    min_distance = squared_distance(features, pos_start, parameters)
+    pos_min = pos_start
+
+    stack_node[0] = 0
+    stack_bound[0] = 0.0
+    size = 1
+    while size > 0:
+        size = size - 1
+        node = stack_node[size]
+        # a subtree is only discarded if all its samples are strictly farther
+        if stack_bound[size] > min_distance:
+            continue
+
+        pos = node_sample[node]
+        distance = squared_distance(features, pos, parameters)
+        if distance < min_distance or (distance == min_distance and pos < pos_min):
+            min_distance = distance
             pos_min = pos
 
+        dim = node_dim[node]
+        difference = parameters[dim] - features[pos, dim]
+        if difference < 0:
+            near = node_left[node]
+            far = node_right[node]
+        else:
+            near = node_right[node]
+            far = node_left[node]
+
+        if far >= 0:
+            stack_node[size] = far
+            stack_bound[size] = difference * difference
+            size = size + 1
+        if near >= 0:
+            stack_node[size] = near
+            stack_bound[size] = 0.0
+            size = size + 1
+
+    return pos_min, min_distance
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def compute_mhd_labels_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, tile_size=16):
+    labels = np.zeros((image.shape[0], image.shape[1]), dtype=np.int32)
+    distances = np.zeros((image.shape[0], image.shape[1]), dtype=np.float32)
+
+    num_samples = features.shape[0]
+
+    # each thread processes a tile of rows, in the same order the image is stored
+    num_tiles = (image.shape[0] + tile_size - 1) // tile_size
+    for tile in prange(num_tiles):
+        stack_node = np.zeros(num_samples + 1, dtype=np.int64)
+        stack_bound = np.zeros(num_samples + 1, dtype=np.float32)
+        parameters = np.zeros(dims.shape[0], dtype=np.float32)
+        pos_min = 0
+        for y in range(tile * tile_size, min((tile + 1) * tile_size, image.shape[0])):
+            for x in range(image.shape[1]):
+                compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+
+                # neighbour pixels usually have the same nearest sample, so it is a good initial bound
+                pos_min, distances[y, x] = query_mhd_index(features, node_sample, node_dim, node_left, node_right, parameters, pos_min, stack_node, stack_bound)
+                labels[y, x] = pos_min
+
+    return labels, distances
+
+
+def build_mhd_query(positions, colors, image_shape, mhd_parameters_values):
+    """Returns the structure used by compute_mhd_position to find the nearest sample of one
+    pixel: the features, the tables, the kd-tree and the buffers of the search. It only has
+    to be built again when the samples, the parameters or the size of the image change
+    """
+    features, dims, x_table, y_table = compute_features(positions, colors, image_shape, mhd_parameters_values)
+    node_sample, node_dim, node_left, node_right = build_mhd_index(features)
+    stack_node = np.zeros(features.shape[0] + 1, dtype=np.int64)
+    stack_bound = np.zeros(features.shape[0] + 1, dtype=np.float32)
+    parameters = np.zeros(dims.shape[0], dtype=np.float32)
+    return features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, stack_node, stack_bound, parameters
+
+
+@jit(nopython=True, cache=True)
+def query_mhd_position(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, stack_node, stack_bound, parameters, image, x, y, pos_start):
+    compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+    return query_mhd_index(features, node_sample, node_dim, node_left, node_right, parameters, pos_start, stack_node, stack_bound)
+
+
+def compute_mhd_position(query, image, x, y, pos_start=0):
+    """Returns the index of the nearest sample of the pixel (x, y), using the structure of
+    build_mhd_query. pos_start is the initial candidate, usually the previous result
+    """
+    pos_min, min_distance = query_mhd_position(*query, image, x, y, pos_start)
     return pos_min
 
 
-@jit
-def compute_mhd(positions, colors, image, mhd_parameters_values):
-    result = np.zeros(image.shape, dtype=np.uint8)
+@jit(nopython=True, parallel=True, cache=True)
+def update_mhd_labels_added(features, dims, x_table, y_table, image, labels, distances, added, tile_size=16):
+    # only the new sample is checked. The labels of the samples after it are moved one place
+    num_tiles = (image.shape[0] + tile_size - 1) // tile_size
+    for tile in prange(num_tiles):
+        parameters = np.zeros(dims.shape[0], dtype=np.float32)
+        for y in range(tile * tile_size, min((tile + 1) * tile_size, image.shape[0])):
+            for x in range(image.shape[1]):
+                if labels[y, x] >= added:
+                    labels[y, x] = labels[y, x] + 1
 
-    width = image.shape[1]-1
-    height = image.shape[0]-1
+                compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+                distance = squared_distance(features, added, parameters)
+                if distance < distances[y, x] or (distance == distances[y, x] and added < labels[y, x]):
+                    distances[y, x] = distance
+                    labels[y, x] = added
 
-    parameters = np.zeros(5)
-    for x in range(image.shape[1]):
-        parameters[3] = x/width
-        for y in range(image.shape[0]):
-            parameters[4] = y/height
 
-            color = image[y, x]
+@jit(nopython=True, parallel=True, cache=True)
+def update_mhd_labels_removed(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, labels, distances, removed, tile_size=16):
+    # only the pixels of the removed sample are searched again. The labels of the samples
+    # after it are moved one place
+    num_samples = features.shape[0]
 
-            parameters[0] = float(color[0]) / 255.0
-            parameters[1] = float(color[1]) / 255.0
-            parameters[2] = float(color[2]) / 255.0
+    num_tiles = (image.shape[0] + tile_size - 1) // tile_size
+    for tile in prange(num_tiles):
+        stack_node = np.zeros(num_samples + 1, dtype=np.int64)
+        stack_bound = np.zeros(num_samples + 1, dtype=np.float32)
+        parameters = np.zeros(dims.shape[0], dtype=np.float32)
+        pos_min = 0
+        for y in range(tile * tile_size, min((tile + 1) * tile_size, image.shape[0])):
+            for x in range(image.shape[1]):
+                if labels[y, x] == removed:
+                    compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+                    pos_min, distances[y, x] = query_mhd_index(features, node_sample, node_dim, node_left, node_right, parameters, pos_min, stack_node, stack_bound)
+                    labels[y, x] = pos_min
+                elif labels[y, x] > removed:
+                    labels[y, x] = labels[y, x] - 1
 
-            # if x==100:
-            #     print("Color ", color)
-            #     print("Parameters ", parameters)
 
-            min = 1e10
-            pos_min = 0
-            parameters_know = np.zeros(5)
-            for pos in range(len(positions)):
-                parameters_know[0] = float(colors[pos][0]) / 255.0
-                parameters_know[1] = float(colors[pos][1]) / 255.0
-                parameters_know[2] = float(colors[pos][2]) / 255.0
-                parameters_know[3] = positions[pos][1]/width
-                parameters_know[4] = positions[pos][0]/height
+NUM_COLOR_CODES = 256 * 256 * 256
+UNIQUE_COLORS_ROW = 64
+COLOR_BLOCK_BITS = 12
 
-                sum = 0.0
-                for i in range(5):
-                    if mhd_parameters_values[i]:
-                        sum = sum + (parameters[i]-parameters_know[i])**2
 
-                distance = math.sqrt(sum)
-                if distance < min:
-                    min = distance
-                    pos_min = pos
+@jit(nopython=True, parallel=True, cache=True)
+def mark_image_colors(image, used, used_blocks):
+    # the same value is written by all the threads, so the races do not matter. used_blocks
+    # marks the blocks of COLOR_BLOCK_BITS bits that have some color, so only these are read
+    for y in prange(image.shape[0]):
+        for x in range(image.shape[1]):
+            code = (np.int64(image[y, x, 0]) << 16) | (np.int64(image[y, x, 1]) << 8) | np.int64(image[y, x, 2])
+            used[code] = 1
+            used_blocks[code >> COLOR_BLOCK_BITS] = 1
 
-            result[y, x] = colors[pos_min]
-            # result[y, x] = [255,0,255,255]
 
-            # if x == 100:
-            #     print("Result ", result[y, x])
-    return result
+@jit(nopython=True, cache=True)
+def collect_image_colors(used, used_blocks):
+    # the codes of the colors marked by mark_image_colors, in increasing order
+    num_codes = 0
+    codes = np.empty(used.shape[0], dtype=np.int64)
+    for block in range(used_blocks.shape[0]):
+        if used_blocks[block]:
+            for code in range(block << COLOR_BLOCK_BITS, (block + 1) << COLOR_BLOCK_BITS):
+                if used[code]:
+                    codes[num_codes] = code
+                    num_codes += 1
+    return codes[:num_codes].copy()
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def gather_color_labels(image, label_table, distance_table):
+    labels = np.empty((image.shape[0], image.shape[1]), dtype=np.int32)
+    distances = np.empty((image.shape[0], image.shape[1]), dtype=np.float32)
+    for y in prange(image.shape[0]):
+        for x in range(image.shape[1]):
+            code = (np.int64(image[y, x, 0]) << 16) | (np.int64(image[y, x, 1]) << 8) | np.int64(image[y, x, 2])
+            labels[y, x] = label_table[code]
+            distances[y, x] = distance_table[code]
+    return labels, distances
+
+
+def compute_mhd_labels_colors(features, dims, x_table, y_table, image, tile_size=16):
+    """Returns the same as compute_mhd_labels_index when only the colors are used. The nearest
+    sample depends only on the color of the pixel, so it is searched once for each color of
+    the image and copied to the pixels with a table indexed by the color
+    """
+    used = np.zeros(NUM_COLOR_CODES, dtype=np.uint8)
+    used_blocks = np.zeros(NUM_COLOR_CODES >> COLOR_BLOCK_BITS, dtype=np.uint8)
+    mark_image_colors(image, used, used_blocks)
+    codes = collect_image_colors(used, used_blocks)
+
+    node_sample, node_dim, node_left, node_right = build_mhd_index(features)
+    if codes.shape[0] * 2 > image.shape[0] * image.shape[1]:
+        # most of the colors are different, so the table does not save searches
+        return compute_mhd_labels_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, tile_size)
+
+    # the colors as an image of rows of UNIQUE_COLORS_ROW colors, sorted so the previous color
+    # of the row is a good initial bound. The last row is completed with the last color
+    num_rows = (codes.shape[0] + UNIQUE_COLORS_ROW - 1) // UNIQUE_COLORS_ROW
+    codes_image = np.full(num_rows * UNIQUE_COLORS_ROW, codes[-1], dtype=np.int64)
+    codes_image[:codes.shape[0]] = codes
+    image_colors = np.empty((num_rows, UNIQUE_COLORS_ROW, 3), dtype=np.uint8)
+    image_colors[:, :, 0] = (codes_image >> 16).reshape((num_rows, UNIQUE_COLORS_ROW))
+    image_colors[:, :, 1] = ((codes_image >> 8) & 255).reshape((num_rows, UNIQUE_COLORS_ROW))
+    image_colors[:, :, 2] = (codes_image & 255).reshape((num_rows, UNIQUE_COLORS_ROW))
+
+    labels_colors, distances_colors = compute_mhd_labels_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image_colors, tile_size)
+
+    # np.empty does not touch the memory, so only the pages of the colors of the image are used
+    label_table = np.empty(NUM_COLOR_CODES, dtype=np.int32)
+    distance_table = np.empty(NUM_COLOR_CODES, dtype=np.float32)
+    label_table[codes] = labels_colors.reshape(-1)[:codes.shape[0]]
+    distance_table[codes] = distances_colors.reshape(-1)[:codes.shape[0]]
+    return gather_color_labels(image, label_table, distance_table)
+
+
+# relative margin of the bounds of the grid, which are computed with the pixel coordinates,
+# so the samples at the same distance with float32 are not discarded
+GRID_MARGIN = 1e-4
+
+
+@jit(nopython=True, cache=True)
+def get_ring_cells(cell_x, cell_y, ring, num_cells_x, num_cells_y, cells):
+    # the cells of the grid at a Chebyshev distance ring from (cell_x, cell_y)
+    num_cells = 0
+    for y in range(max(cell_y - ring, 0), min(cell_y + ring + 1, num_cells_y)):
+        if y == cell_y - ring or y == cell_y + ring:
+            for x in range(max(cell_x - ring, 0), min(cell_x + ring + 1, num_cells_x)):
+                cells[num_cells] = y * num_cells_x + x
+                num_cells += 1
+        else:
+            if cell_x - ring >= 0:
+                cells[num_cells] = y * num_cells_x + cell_x - ring
+                num_cells += 1
+            if cell_x + ring < num_cells_x:
+                cells[num_cells] = y * num_cells_x + cell_x + ring
+                num_cells += 1
+    return num_cells
+
+
+@jit(nopython=True, cache=True)
+def get_ring_distance(ring, num_cells_x, num_cells_y, cell_width, cell_height, weight_x, weight_y):
+    # lower bound of the squared distance between a block of a cell and the samples of the ring
+    if ring == 0:
+        return 0.0
+    distance = np.inf
+    if num_cells_x > 1:
+        gap = (ring - 1) * cell_width + 1
+        distance = min(distance, weight_x * gap * gap)
+    if num_cells_y > 1:
+        gap = (ring - 1) * cell_height + 1
+        distance = min(distance, weight_y * gap * gap)
+    return distance
+
+
+@jit(nopython=True, cache=True)
+def find_grid_candidates(cell_start, cell_samples, sample_x, sample_y, weight_x, weight_y, cell_width, cell_height, num_cells_x, num_cells_y,
+                         cell_x, cell_y, x0, x1, y0, y1, cells, candidates):
+    # the samples that can be the nearest one of some pixel of the block [x0, x1] x [y0, y1].
+    # The smallest of the largest distances from a sample to the block is a bound for all the
+    # pixels, and the samples whose distance to the block is greater are discarded
+    num_rings = max(num_cells_x, num_cells_y)
+    bound = np.inf
+    for ring in range(num_rings):
+        if get_ring_distance(ring, num_cells_x, num_cells_y, cell_width, cell_height, weight_x, weight_y) > bound:
+            break
+        num_cells = get_ring_cells(cell_x, cell_y, ring, num_cells_x, num_cells_y, cells)
+        for i in range(num_cells):
+            for j in range(cell_start[cells[i]], cell_start[cells[i] + 1]):
+                pos = cell_samples[j]
+                dx = max(sample_x[pos] - x0, x1 - sample_x[pos])
+                dy = max(sample_y[pos] - y0, y1 - sample_y[pos])
+                bound = min(bound, weight_x * dx * dx + weight_y * dy * dy)
+    bound = bound * (1.0 + GRID_MARGIN)
+
+    num_candidates = 0
+    for ring in range(num_rings):
+        if get_ring_distance(ring, num_cells_x, num_cells_y, cell_width, cell_height, weight_x, weight_y) > bound:
+            break
+        num_cells = get_ring_cells(cell_x, cell_y, ring, num_cells_x, num_cells_y, cells)
+        for i in range(num_cells):
+            for j in range(cell_start[cells[i]], cell_start[cells[i] + 1]):
+                pos = cell_samples[j]
+                dx = max(x0 - sample_x[pos], sample_x[pos] - x1, 0)
+                dy = max(y0 - sample_y[pos], sample_y[pos] - y1, 0)
+                if weight_x * dx * dx + weight_y * dy * dy <= bound:
+                    candidates[num_candidates] = pos
+                    num_candidates += 1
+    return num_candidates
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def compute_mhd_labels_grid_kernel(features, dims, x_table, y_table, image, cell_start, cell_samples, sample_x, sample_y, weight_x, weight_y, cell_width, cell_height, tile_size=16):
+    labels = np.zeros((image.shape[0], image.shape[1]), dtype=np.int32)
+    distances = np.zeros((image.shape[0], image.shape[1]), dtype=np.float32)
+
+    num_samples = features.shape[0]
+    num_cells_x = (image.shape[1] + cell_width - 1) // cell_width
+    num_cells_y = (image.shape[0] + cell_height - 1) // cell_height
+
+    # each thread processes a band of tile_size rows or less inside a row of cells, and the
+    # candidates are searched for each block of the band inside a cell
+    bands_per_cell = (cell_height + tile_size - 1) // tile_size
+    band_height = (cell_height + bands_per_cell - 1) // bands_per_cell
+    for band in prange(num_cells_y * bands_per_cell):
+        cells = np.zeros(8 * max(num_cells_x, num_cells_y) + 1, dtype=np.int64)
+        candidates = np.zeros(num_samples, dtype=np.int64)
+        parameters = np.zeros(dims.shape[0], dtype=np.float32)
+        cell_y = band // bands_per_cell
+        y0 = cell_y * cell_height + (band % bands_per_cell) * band_height
+        y1 = min(y0 + band_height, (cell_y + 1) * cell_height, image.shape[0]) - 1
+        for cell_x in range(num_cells_x):
+            x0 = cell_x * cell_width
+            x1 = min(x0 + cell_width, image.shape[1]) - 1
+            num_candidates = find_grid_candidates(cell_start, cell_samples, sample_x, sample_y, weight_x, weight_y, cell_width, cell_height, num_cells_x, num_cells_y,
+                                                  cell_x, cell_y, x0, x1, y0, y1, cells, candidates)
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+                    # the same distances as the other kernels, and the lowest index in a tie
+                    pos_min = -1
+                    distance_min = np.float32(np.inf)
+                    for i in range(num_candidates):
+                        pos = candidates[i]
+                        distance = squared_distance(features, pos, parameters)
+                        if distance < distance_min or (distance == distance_min and pos < pos_min):
+                            pos_min = pos
+                            distance_min = distance
+                    labels[y, x] = pos_min
+                    distances[y, x] = distance_min
+
+    return labels, distances
+
+
+def compute_mhd_labels_grid(positions, features, dims, x_table, y_table, image, tile_size=16):
+    """Returns the same as compute_mhd_labels_index when only the positions are used, in a time
+    that depends on the pixels and not on the number of samples. The samples are put in a grid
+    of cells with one sample on average, and only the samples of the nearby cells that can be
+    the nearest one of a block of pixels are compared
+    """
+    use_x = 3 in dims
+    use_y = 4 in dims
+    num_samples = len(positions)
+    width = image.shape[1] - 1
+    height = image.shape[0] - 1
+
+    # the cells are square with the normalized coordinates. A coordinate that is not used
+    # has only one cell
+    if use_x and use_y:
+        num_cells = int(math.ceil(math.sqrt(num_samples)))
+    else:
+        num_cells = num_samples
+    cell_width = (image.shape[1] + num_cells - 1) // num_cells if use_x else image.shape[1]
+    cell_height = (image.shape[0] + num_cells - 1) // num_cells if use_y else image.shape[0]
+    num_cells_x = (image.shape[1] + cell_width - 1) // cell_width
+    num_cells_y = (image.shape[0] + cell_height - 1) // cell_height
+
+    # the samples outside the image are put in the nearest cell, which is nearer to all the
+    # pixels, so the bounds of the rings are still valid. The distances use the real coordinates
+    sample_x = np.asarray(positions)[:, 1].astype(np.int64)
+    sample_y = np.asarray(positions)[:, 0].astype(np.int64)
+    sample_cells = (np.clip(sample_y, 0, height) // cell_height) * num_cells_x + np.clip(sample_x, 0, width) // cell_width
+    cell_samples = np.argsort(sample_cells, kind='stable').astype(np.int64)
+    cell_start = np.zeros(num_cells_x * num_cells_y + 1, dtype=np.int64)
+    cell_start[1:] = np.cumsum(np.bincount(sample_cells, minlength=num_cells_x * num_cells_y))
+
+    weight_x = 1.0 / (width * width) if use_x else 0.0
+    weight_y = 1.0 / (height * height) if use_y else 0.0
+    return compute_mhd_labels_grid_kernel(features, dims, x_table, y_table, image, cell_start, cell_samples, sample_x, sample_y, weight_x, weight_y, cell_width, cell_height, tile_size)
+
+
+def compute_mhd_labels_fast_path(positions, features, dims, x_table, y_table, image, tile_size=16):
+    # the labels when no parameter, only the colors or only the positions are used, otherwise
+    # None. Without parameters all the samples are at distance 0, so the first one is used
+    if dims.shape[0] == 0:
+        return np.zeros((image.shape[0], image.shape[1]), dtype=np.int32), np.zeros((image.shape[0], image.shape[1]), dtype=np.float32)
+    if dims.max() < 3:
+        return compute_mhd_labels_colors(features, dims, x_table, y_table, image, tile_size)
+    if dims.min() >= 3:
+        return compute_mhd_labels_grid(positions, features, dims, x_table, y_table, image, tile_size)
+    return None
+
+
+def compute_mhd_labels(positions, colors, image, mhd_parameters_values, use_index=True, tile_size=16):
+    """Returns the index of the nearest sample of each pixel and the squared distance to it.
+    With use_index=False the brute force kernel is used, which is useful to validate the
+    results of the index
+    """
+    numba.set_num_threads(num_threads)
+
+    features, dims, x_table, y_table = compute_features(positions, colors, image.shape, mhd_parameters_values)
+
+    if not use_index:
+        return compute_mhd_labels_brute_force(features, dims, x_table, y_table, image, tile_size)
+
+    result = compute_mhd_labels_fast_path(positions, features, dims, x_table, y_table, image, tile_size)
+    if result is not None:
+        return result
+
+    node_sample, node_dim, node_left, node_right = build_mhd_index(features)
+    return compute_mhd_labels_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, tile_size)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def refine_mhd_labels(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, coarse_labels, coarse_step, step, tile_size=16):
+    # labels of the pixels (y*step, x*step). If the 4 pixels of coarse_labels around a pixel
+    # have the same label it is used, otherwise the nearest sample is searched
+    height = (image.shape[0] + step - 1) // step
+    width = (image.shape[1] + step - 1) // step
+    labels = np.zeros((height, width), dtype=np.int32)
+    distances = np.zeros((height, width), dtype=np.float32)
+
+    num_samples = features.shape[0]
+
+    num_tiles = (height + tile_size - 1) // tile_size
+    for tile in prange(num_tiles):
+        stack_node = np.zeros(num_samples + 1, dtype=np.int64)
+        stack_bound = np.zeros(num_samples + 1, dtype=np.float32)
+        parameters = np.zeros(dims.shape[0], dtype=np.float32)
+        pos_min = 0
+        for row in range(tile * tile_size, min((tile + 1) * tile_size, height)):
+            y = row * step
+            y0 = y // coarse_step
+            y1 = y0 if y == y0 * coarse_step else y0 + 1
+            for column in range(width):
+                x = column * step
+                x0 = x // coarse_step
+                x1 = x0 if x == x0 * coarse_step else x0 + 1
+
+                compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+
+                if y1 < coarse_labels.shape[0] and x1 < coarse_labels.shape[1]:
+                    label = coarse_labels[y0, x0]
+                    if coarse_labels[y0, x1] == label and coarse_labels[y1, x0] == label and coarse_labels[y1, x1] == label:
+                        labels[row, column] = label
+                        distances[row, column] = squared_distance(features, label, parameters)
+                        pos_min = label
+                        continue
+                    pos_min = label
+
+                pos_min, distances[row, column] = query_mhd_index(features, node_sample, node_dim, node_left, node_right, parameters, pos_min, stack_node, stack_bound)
+                labels[row, column] = pos_min
+
+    return labels, distances
+
+
+def get_preview_step(image_shape, preview_pixels):
+    # the smallest power of 2 that reduces the image to preview_pixels or less
+    step = 1
+    while ((image_shape[0] + step - 1) // step) * ((image_shape[1] + step - 1) // step) > preview_pixels:
+        step = step * 2
+    return step
+
+
+def compute_mhd_labels_progressive(positions, colors, image, mhd_parameters_values, preview_pixels, report, threshold=None, tile_size=16):
+    """Returns the same as compute_mhd_labels, but first the labels are computed over a coarse
+    grid of pixels, and each level halves the step. Only the pixels whose coarse neighbours
+    have different labels are searched again. report(labels, step) is called with the labels of
+    each level before the last one; if it returns False the computation stops and None is
+    returned. The last level is computed completely; if threshold is given it is computed with
+    the differences in the same pass, and the result is the same as compute_mhd_differences.
+    When only the colors or only the positions are used the labels are computed directly, as
+    it is faster than the first level
+    """
+    numba.set_num_threads(num_threads)
+
+    if threshold is not None:
+        colors = np.ascontiguousarray(colors, dtype=np.uint8)
+    features, dims, x_table, y_table = compute_features(positions, colors, image.shape, mhd_parameters_values)
+    result = compute_mhd_labels_fast_path(positions, features, dims, x_table, y_table, image, tile_size)
+    if result is not None:
+        if threshold is None:
+            return result
+        labels, distances = result
+        image_mhd, differences, percentage = compute_mhd_image_differences(labels, colors, image, get_threshold_squared(threshold), tile_size)
+        return labels, distances, image_mhd, differences, percentage
+
+    node_sample, node_dim, node_left, node_right = build_mhd_index(features)
+
+    step = get_preview_step(image.shape, preview_pixels)
+    labels = np.zeros((0, 0), dtype=np.int32)
+    coarse_step = 1
+    while step > 1:
+        labels, distances = refine_mhd_labels(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, labels, coarse_step, step, tile_size)
+        if not report(labels, step):
+            return None
+        coarse_step = step
+        step = step // 2
+
+    if threshold is not None:
+        return compute_mhd_differences_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, colors, get_threshold_squared(threshold), tile_size)
+    return compute_mhd_labels_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, tile_size)
+
+
+def add_mhd_position(positions, colors, image, mhd_parameters_values, labels, distances, added, tile_size=16):
+    """Updates the labels and distances of compute_mhd_labels when the sample in the
+    position 'added' has been inserted. positions and colors include the new sample
+    """
+    numba.set_num_threads(num_threads)
+
+    features, dims, x_table, y_table = compute_features(positions, colors, image.shape, mhd_parameters_values)
+    update_mhd_labels_added(features, dims, x_table, y_table, image, labels, distances, added, tile_size)
+
+
+def remove_mhd_position(positions, colors, image, mhd_parameters_values, labels, distances, removed, tile_size=16):
+    """Updates the labels and distances of compute_mhd_labels when the sample in the
+    position 'removed' has been deleted. positions and colors do not include it
+    """
+    numba.set_num_threads(num_threads)
+
+    features, dims, x_table, y_table = compute_features(positions, colors, image.shape, mhd_parameters_values)
+    node_sample, node_dim, node_left, node_right = build_mhd_index(features)
+    update_mhd_labels_removed(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, labels, distances, removed, tile_size)
+
+
+def compute_mhd(positions, colors, image, mhd_parameters_values, use_index=True, tile_size=16):
+    labels, distances = compute_mhd_labels(positions, colors, image, mhd_parameters_values, use_index, tile_size)
+    return colors[labels].astype(np.uint8)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def quantize_lightness(image_hls, low, high, middle):
+    # the L component is set to 0 if it is lower than low, to 255 if it is greater than high,
+    # and to middle otherwise. The image is modified
+    for y in prange(image_hls.shape[0]):
+        for x in range(image_hls.shape[1]):
+            if image_hls[y, x, 1] < low:
+                image_hls[y, x, 1] = 0
+            elif image_hls[y, x, 1] > high:
+                image_hls[y, x, 1] = 255
+            else:
+                image_hls[y, x, 1] = middle
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def assign_clusters(values, centers):
+    # index of the nearest center of each value. In case of a tie, the lowest index
+    labels = np.zeros(values.shape[0], dtype=np.int32)
+    for pos in prange(values.shape[0]):
+        min_distance = np.inf
+        pos_min = 0
+        for center in range(centers.shape[0]):
+            distance = 0.0
+            for i in range(values.shape[1]):
+                distance = distance + (values[pos, i] - centers[center, i])**2
+            if distance < min_distance:
+                min_distance = distance
+                pos_min = center
+        labels[pos] = pos_min
+    return labels
+
 
 # @jit
 # def compute_differences(image_original, image_mhd):
@@ -108,25 +696,208 @@ def compute_mhd(positions, colors, image, mhd_parameters_values):
 # def compute_differences(image_original, image_mhd):
 #     return np.abs(image_original-image_original)
 
-@jit
+@jit(nopython=True, cache=True)
+def squared_color_difference(color1, color2):
+    # the components are converted to int before subtracting them
+    value = 0
+    for i in range(3):
+        difference = np.int32(color1[i]) - np.int32(color2[i])
+        value = value + difference * difference
+    return value
+
+
+def get_threshold_squared(threshold):
+    # the threshold is a percentage of the maximum distance between two colors (442)
+    threshold = (threshold * 442) / 100.0
+    return threshold * threshold
+
+
+@jit(nopython=True, parallel=True, cache=True)
 def compute_differences(image_original, image_mhd, threshold):
-    if image_original is image_mhd:
-        print("---------------------------")
-    result = np.zeros(image_original.shape, dtype=np.uint8)
+    # returns a 1 channel mask with 255 where the color distance is greater than the threshold,
+    # and the exact percentage of those pixels. The squared distance is compared with the
+    # squared threshold
+    result = np.zeros((image_original.shape[0], image_original.shape[1]), dtype=np.uint8)
 
-    num_different=0
     threshold = (threshold * 442) / 100.0
-    for x in range(image_original.shape[1]):
-        for y in range(image_original.shape[0]):
-            value = np.sqrt(np.sum((image_original[y,x]-image_mhd[y,x])**2))
-            # if y==0 and x<10:
-            #     print("1 ", image_original[y,x])
-            #     print("2 ", image_mhd[y, x])
-            #     print(value)
-            if value > threshold:
+    threshold_squared = threshold * threshold
+    num_different_rows = np.zeros(image_original.shape[0], dtype=np.int64)
+    for y in prange(image_original.shape[0]):
+        num_different = 0
+        for x in range(image_original.shape[1]):
+            if squared_color_difference(image_original[y, x], image_mhd[y, x]) > threshold_squared:
                 num_different = num_different + 1
-                result[y,x] = [255, 255, 255]
-            else:
-                result[y,x] = [0, 0, 0]
+                result[y, x] = 255
+        num_different_rows[y] = num_different
+
+    return result, float(num_different_rows.sum())*100.0/(result.shape[0]*result.shape[1])
+
+
+# maximum squared distance between two colors
+MAX_SQUARED_COLOR_DIFFERENCE = 3 * 255 * 255
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def compute_color_distances(image_original, image_mhd):
+    # squared color distance of each pixel, so the differences can be computed again for other
+    # thresholds without the images
+    distances = np.zeros((image_original.shape[0], image_original.shape[1]), dtype=np.int32)
+    for y in prange(image_original.shape[0]):
+        for x in range(image_original.shape[1]):
+            distances[y, x] = squared_color_difference(image_original[y, x], image_mhd[y, x])
+    return distances
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def threshold_color_distances(distances, threshold_squared):
+    # the same mask as compute_differences
+    result = np.zeros(distances.shape, dtype=np.uint8)
+    for y in prange(distances.shape[0]):
+        for x in range(distances.shape[1]):
+            if distances[y, x] > threshold_squared:
+                result[y, x] = 255
+    return result
+
+
+def compute_distance_counts(distances):
+    """Returns the number of pixels with a squared distance less than or equal to each value"""
+    return np.cumsum(np.bincount(distances.ravel(), minlength=MAX_SQUARED_COLOR_DIFFERENCE + 1))
+
+
+def get_differences_percentage(distance_counts, threshold):
+    # the distances are integers, so d > t is the same as d > floor(t)
+    index = min(int(math.floor(get_threshold_squared(threshold))), len(distance_counts) - 1)
+    total = distance_counts[-1]
+    return float(total - distance_counts[index]) * 100.0 / total
+
+
+def compute_threshold_curve(distance_counts, num_thresholds=101):
+    """Returns the percentage of differences for the thresholds 0, 1, ..., num_thresholds-1"""
+    return np.array([get_differences_percentage(distance_counts, threshold) for threshold in range(num_thresholds)])
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def compute_mhd_differences_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, colors, threshold_squared, tile_size=16):
+    # the nearest sample of each pixel is searched, and its color is written in the MHD image
+    # and compared with the pixel in the same step
+    labels = np.zeros((image.shape[0], image.shape[1]), dtype=np.int32)
+    distances = np.zeros((image.shape[0], image.shape[1]), dtype=np.float32)
+    image_mhd = np.zeros(image.shape, dtype=np.uint8)
+    differences = np.zeros((image.shape[0], image.shape[1]), dtype=np.uint8)
+
+    num_samples = features.shape[0]
+
+    num_tiles = (image.shape[0] + tile_size - 1) // tile_size
+    num_different_tiles = np.zeros(num_tiles, dtype=np.int64)
+    for tile in prange(num_tiles):
+        stack_node = np.zeros(num_samples + 1, dtype=np.int64)
+        stack_bound = np.zeros(num_samples + 1, dtype=np.float32)
+        parameters = np.zeros(dims.shape[0], dtype=np.float32)
+        pos_min = 0
+        num_different = 0
+        for y in range(tile * tile_size, min((tile + 1) * tile_size, image.shape[0])):
+            for x in range(image.shape[1]):
+                compute_pixel_features(image, x, y, dims, x_table, y_table, parameters)
+                pos_min, distances[y, x] = query_mhd_index(features, node_sample, node_dim, node_left, node_right, parameters, pos_min, stack_node, stack_bound)
+                labels[y, x] = pos_min
+
+                for i in range(3):
+                    image_mhd[y, x, i] = colors[pos_min, i]
+                if squared_color_difference(image[y, x], colors[pos_min]) > threshold_squared:
+                    num_different = num_different + 1
+                    differences[y, x] = 255
+        num_different_tiles[tile] = num_different
+
+    return labels, distances, image_mhd, differences, float(num_different_tiles.sum())*100.0/(image.shape[0]*image.shape[1])
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def compute_mhd_image_differences(labels, colors, image, threshold_squared, tile_size=16):
+    # the MHD image and the differences from the labels, in one pass
+    image_mhd = np.zeros(image.shape, dtype=np.uint8)
+    differences = np.zeros((image.shape[0], image.shape[1]), dtype=np.uint8)
+
+    num_tiles = (image.shape[0] + tile_size - 1) // tile_size
+    num_different_tiles = np.zeros(num_tiles, dtype=np.int64)
+    for tile in prange(num_tiles):
+        num_different = 0
+        for y in range(tile * tile_size, min((tile + 1) * tile_size, image.shape[0])):
+            for x in range(image.shape[1]):
+                label = labels[y, x]
+                for i in range(3):
+                    image_mhd[y, x, i] = colors[label, i]
+                if squared_color_difference(image[y, x], colors[label]) > threshold_squared:
+                    num_different = num_different + 1
+                    differences[y, x] = 255
+        num_different_tiles[tile] = num_different
+
+    return image_mhd, differences, float(num_different_tiles.sum())*100.0/(image.shape[0]*image.shape[1])
+
+
+def compute_mhd_differences(positions, colors, image, mhd_parameters_values, threshold, use_index=True, tile_size=16):
+    """Computes the labels, the MHD image and the differences between image and the MHD image
+    in one pass. Returns labels, distances, image_mhd, differences and the percentage
+    """
+    numba.set_num_threads(num_threads)
+
+    colors = np.ascontiguousarray(colors, dtype=np.uint8)
+    threshold_squared = get_threshold_squared(threshold)
+    features, dims, x_table, y_table = compute_features(positions, colors, image.shape, mhd_parameters_values)
+
+    result = compute_mhd_labels_fast_path(positions, features, dims, x_table, y_table, image, tile_size) if use_index else None
+    if not use_index or result is not None:
+        if use_index:
+            labels, distances = result
+        else:
+            labels, distances = compute_mhd_labels_brute_force(features, dims, x_table, y_table, image, tile_size)
+        image_mhd, differences, percentage = compute_mhd_image_differences(labels, colors, image, threshold_squared, tile_size)
+        return labels, distances, image_mhd, differences, percentage
+
+    node_sample, node_dim, node_left, node_right = build_mhd_index(features)
+    return compute_mhd_differences_index(features, dims, x_table, y_table, node_sample, node_dim, node_left, node_right, image, colors, threshold_squared, tile_size)
+
+
+def compute_mhd_image(labels, colors, image, threshold=None, tile_size=16):
+    """Returns the MHD image of the labels. If threshold is given, also the differences with
+    image and the percentage
+    """
+    colors = np.ascontiguousarray(colors, dtype=np.uint8)
+    if threshold is None:
+        return colors[labels]
+
+    numba.set_num_threads(num_threads)
+    return compute_mhd_image_differences(labels, colors, image, get_threshold_squared(threshold), tile_size)
+
+
+def compile_kernels(mhd_parameters_values):
+    """Calls the kernels with a small image and the same types used by the program, so they are
+    compiled (or loaded from the cache of numba) before the first interaction. Returns the
+    time used
+    """
+    start = time.perf_counter()
+
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    image[4:, :, :] = 200
+    positions = np.array([[0, 0], [7, 7], [3, 5]])
+    colors = np.array([image[0, 0], image[7, 7], image[3, 5]])
+    mhd_parameters_values = list(mhd_parameters_values)
+
+    compute_mhd_position(build_mhd_query(positions, colors, image.shape, mhd_parameters_values), image, 1, 1)
+    for use_index in (True, False):
+        labels, distances = compute_mhd_labels(positions, colors, image, mhd_parameters_values, use_index)
+    add_mhd_position(positions, colors, image, mhd_parameters_values, labels, distances, 2)
+    remove_mhd_position(positions[:2], colors[:2], image, mhd_parameters_values, labels, distances, 2)
+    compute_mhd_differences(positions, colors, image, mhd_parameters_values, 0)
+    compute_mhd_labels_progressive(positions, colors, image, mhd_parameters_values, 16, lambda labels, step: True)
+    compute_mhd_labels_progressive(positions, colors, image, mhd_parameters_values, 16, lambda labels, step: True, 0)
+    compute_mhd_labels(positions, colors, image, [True, True, True, False, False])
+    compute_mhd_labels(positions, colors, image, [False, False, False, True, True])
+    image_mhd, differences, percentage = compute_mhd_image(labels, colors, image, 0)
+    compute_differences(image, image_mhd, 0)
+    threshold_color_distances(compute_color_distances(image, image_mhd), get_threshold_squared(0))
+
+    quantize_lightness(image.copy(), 10, 240, 128)
+    values = image.reshape((-1, 3)).astype(np.float32)
+    assign_clusters(values, values[:2].copy())
 
-    return result, int(float(num_different)*100.0/(result.shape[0]*result.shape[1]))
+    return time.perf_counter() - start
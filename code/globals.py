@@ -9,14 +9,38 @@ BRUSH_MAX_SIZE = 100
 BRUSH_SIZE_DEFAULT = 80
 
 MHD_PARAMETERS = [True, True, True, True, True]
+# False uses the brute force kernel instead of the kd-tree (to validate the results)
+MHD_USE_INDEX = True
+# rows processed by each thread of the MHD kernels
+MHD_TILE_SIZE = 16
+# in images of more than MHD_PROGRESSIVE_MIN_PIXELS, coarse MHD images of about
+# MHD_PREVIEW_PIXELS pixels are shown while the final one is computed. In smaller images the
+# previews would take longer than they save
+MHD_PROGRESSIVE = True
+MHD_PROGRESSIVE_MIN_PIXELS = 2000000
+MHD_PREVIEW_PIXELS = 65536
+# the kernels are compiled in a background thread when the program starts
+COMPILE_KERNELS_AT_STARTUP = True
 
 KMEANS_NUM_CLUSTERS = 10
 KMEANS_NUM_ITERACTIONS = 10
+# the centers are computed with a random subset of the pixels, and then all the pixels are assigned
+KMEANS_SUBSAMPLE = True
+KMEANS_SAMPLE_SIZE = 20000
+KMEANS_SEED = 0
+
+# memory used to keep the results of the preprocessing stages
+PREPROCESSING_CACHE_MAX_MB = 512
 
 TAB_SIZE = 250
 
 COLOR_MODELS = ['RGB', 'HSV', 'HLS']
 
+# quantization of the lightness in the HLS model
+HLS_LIGHTNESS_LOW = 10
+HLS_LIGHTNESS_HIGH = 240
+HLS_LIGHTNESS_MIDDLE = 128
+
 COLOR_SMOOTH_KERNEL_SIZE = [1, 3, 5, 7, 9, 11, 13, 15, 25, 49]
 
 CANVAS_WIDTH = 500
@@ -0,0 +1,66 @@
+import numpy as np
+
+from PySide6.QtCore import QSize, QRect
+from PySide6.QtGui import QImage, QPixmap
+
+
+class image_buffer:
+    """A numpy image and a QImage that uses the same memory, so the widgets paint the numpy
+    image without converting it to a QPixmap, and the pixels are read from numpy.
+    The images received with set_image are not modified: they are copied the first time a
+    region is written
+    """
+
+    def __init__(self, width=1, height=1, color=(255, 255, 255)):
+        self.image = None
+        self.qt_image = None
+        self.owned = False
+        # each pixel of the image is painted as scale x scale pixels
+        self.scale = 1
+        self.fill(width, height, color)
+
+    def set_image(self, image, scale=1):
+        self.scale = scale
+        # the QImage keeps a pointer to the numpy memory, so the image must be contiguous and
+        # it is referenced while the QImage exists
+        self.image = np.ascontiguousarray(image, dtype=np.uint8)
+        self.owned = self.image is not image
+        if self.image.ndim == 2:
+            image_format = QImage.Format.Format_Grayscale8
+        else:
+            image_format = QImage.Format.Format_RGB888
+        self.qt_image = QImage(self.image.data, self.image.shape[1], self.image.shape[0], self.image.strides[0], image_format)
+
+    def fill(self, width, height, color):
+        image = np.empty((max(height, 1), max(width, 1), 3), dtype=np.uint8)
+        image[:, :] = color
+        self.set_image(image)
+        self.owned = True
+
+    def write(self, x0, y0, image):
+        """Copies image into the rectangle whose top left corner is (x0, y0)"""
+        if not self.owned:
+            self.set_image(self.image.copy(), self.scale)
+            self.owned = True
+        self.image[y0:y0 + image.shape[0], x0:x0 + image.shape[1]] = image
+
+    def draw(self, painter, x=0, y=0):
+        if self.scale == 1:
+            painter.drawImage(x, y, self.qt_image)
+        else:
+            painter.drawImage(QRect(x, y, self.image.shape[1] * self.scale, self.image.shape[0] * self.scale), self.qt_image)
+
+    def get_color(self, x, y):
+        x = x // self.scale
+        y = y // self.scale
+        if self.image.ndim == 2:
+            value = int(self.image[y, x])
+            return [value, value, value, 255]
+        return [int(value) for value in self.image[y, x]] + [255]
+
+    def get_size(self):
+        return QSize(self.image.shape[1], self.image.shape[0])
+
+    def get_pixmap(self):
+        # a copy, used to save the image or to paint over it
+        return QPixmap.fromImage(self.qt_image)
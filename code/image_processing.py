@@ -0,0 +1,166 @@
+import numpy as np
+
+import globals
+
+from stage_cache import stage_cache
+
+
+# attributes of image_processor that are parameters of the stages
+PARAMETERS = ('color_model_smooth', 'color_model', 'hls_lightness_low', 'hls_lightness_high', 'hls_lightness_middle',
+              'compute_kmeans_value', 'kmeans_num_clusters_value', 'kmeans_num_iteractions_value', 'kmeans_subsample_value',
+              'kmeans_sample_size', 'kmeans_seed')
+
+
+class image_processor:
+    """Preprocessing of the painting before computing the MHD: blur, color model and k-means.
+    It does not use Qt, so it is shared by painter_widget and the batch program
+    """
+
+    def __init__(self):
+        self.color_model_smooth = 1
+
+        self.color_model = 'RGB'
+
+        self.hls_lightness_low = globals.HLS_LIGHTNESS_LOW
+        self.hls_lightness_high = globals.HLS_LIGHTNESS_HIGH
+        self.hls_lightness_middle = globals.HLS_LIGHTNESS_MIDDLE
+
+        self.compute_kmeans_value = False
+        self.kmeans_num_clusters_value = globals.KMEANS_NUM_CLUSTERS
+        self.kmeans_num_iteractions_value = globals.KMEANS_NUM_ITERACTIONS
+        self.kmeans_subsample_value = globals.KMEANS_SUBSAMPLE
+        self.kmeans_sample_size = globals.KMEANS_SAMPLE_SIZE
+        self.kmeans_seed = globals.KMEANS_SEED
+        # the last centers are used as the initial ones while the image and the previous stages
+        # do not change, so only a change of the k-means parameters uses them
+        self.kmeans_centers = None
+        self.kmeans_centers_key = None
+        self.kmeans_stages_key = None
+
+        self.cache = stage_cache(globals.PREPROCESSING_CACHE_MAX_MB * 1024 * 1024)
+
+    def get_parameters(self):
+        """Returns a copy of the parameters of the stages. The worker thread uses it, as the
+        attributes can be changed by the interface during the computation
+        """
+        return {name: getattr(self, name) for name in PARAMETERS}
+
+    def compute_processed_image(self, image_rgb, image_version=None, copy=True, parameters=None):
+        """Applies the preprocessing to image_rgb and returns the result.
+        The stages use parameters (see get_parameters), or the attributes if it is not given.
+        If image_version is given, the result of each stage is saved in the cache and reused
+        while the image and the parameters of the stage and the previous ones do not change.
+        The images returned can be in the cache, so they must not be modified. If no stage is
+        applied, image_rgb is copied, unless copy is False
+        """
+        if parameters is None:
+            parameters = self.get_parameters()
+        image_processed = image_rgb
+
+        # blur
+        key = ('blur', image_version, parameters['color_model_smooth'])
+        if parameters['color_model_smooth']>1:
+            image_processed = self.get_stage(key, image_processed, self.blur, parameters)
+
+        # color model
+        key = key + ('color', parameters['color_model'])
+        if parameters['color_model'] == 'HLS':
+            key = key + (parameters['hls_lightness_low'], parameters['hls_lightness_high'], parameters['hls_lightness_middle'])
+        if parameters['color_model'] != 'RGB':
+            image_processed = self.get_stage(key, image_processed, self.convert_color_model, parameters)
+
+        # k-means
+        if parameters['compute_kmeans_value'] == True:
+            # without a version the image can be a different one, so it is not warm started
+            self.kmeans_stages_key = key if image_version is not None else None
+            key = key + ('kmeans', parameters['kmeans_num_clusters_value'], parameters['kmeans_num_iteractions_value'], parameters['kmeans_subsample_value'],
+                         parameters['kmeans_sample_size'], parameters['kmeans_seed'])
+            image_processed = self.get_stage(key, image_processed, self.k_means, parameters)
+
+        if copy and image_processed is image_rgb:
+            image_processed = image_rgb.copy()
+
+        return image_processed
+
+    def get_stage(self, key, image, function, parameters):
+        # the key is built with the same parameters, so the result is saved with its own key
+        if key[1] is None:
+            return function(image, parameters)
+
+        result = self.cache.get(key)
+        if result is None:
+            result = function(image, parameters)
+            self.cache.put(key, result)
+        return result
+
+    def blur(self, image, parameters):
+        import cv2
+
+        return cv2.blur(image, (parameters['color_model_smooth'], parameters['color_model_smooth']))
+
+    def convert_color_model(self, image, parameters):
+        import cv2
+        import fast_computation
+
+        if parameters['color_model'] == 'HSV':
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+        elif parameters['color_model'] == 'HLS':
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2HLS)
+            image[:, :, 2] = 255
+            fast_computation.quantize_lightness(image, parameters['hls_lightness_low'], parameters['hls_lightness_high'], parameters['hls_lightness_middle'])
+
+            image = cv2.cvtColor(image, cv2.COLOR_HLS2RGB)
+        return image
+
+    def get_cache_statistics(self):
+        return self.cache.get_statistics()
+
+    def k_means(self, image, parameters):
+        import cv2
+        import fast_computation
+
+        num_clusters = parameters['kmeans_num_clusters_value']
+        num_iteractions = parameters['kmeans_num_iteractions_value']
+
+        Z = image.reshape((-1, 3))
+        # # convert to np.float32
+        Z = np.float32(Z)
+
+        # the same image and parameters always produce the same result
+        cv2.setRNGSeed(parameters['kmeans_seed'])
+        random_generator = np.random.default_rng(parameters['kmeans_seed'])
+        if parameters['kmeans_subsample_value'] and Z.shape[0] > parameters['kmeans_sample_size']:
+            samples = Z[random_generator.choice(Z.shape[0], parameters['kmeans_sample_size'], replace=False)]
+        else:
+            samples = Z
+
+        # define criteria, number of clusters(K) and apply kmeans()
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, num_iteractions, 1.0)
+        if self.kmeans_centers is not None and self.kmeans_stages_key is not None and self.kmeans_centers_key == self.kmeans_stages_key:
+            # warm start: the previous centers, removing the last ones or adding random samples
+            centers = self.kmeans_centers[:num_clusters]
+            if centers.shape[0] < num_clusters:
+                new_centers = samples[random_generator.choice(samples.shape[0], num_clusters - centers.shape[0], replace=False)]
+                centers = np.concatenate((centers, new_centers))
+            initial_labels = fast_computation.assign_clusters(samples, centers).reshape((-1, 1))
+            ret, label, center = cv2.kmeans(samples, num_clusters, initial_labels, criteria, 1, cv2.KMEANS_USE_INITIAL_LABELS)
+        else:
+            ret, label, center = cv2.kmeans(samples, num_clusters, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+
+        self.kmeans_centers = center
+        self.kmeans_centers_key = self.kmeans_stages_key
+
+        # Now convert back into uint8, and make original image
+        label = fast_computation.assign_clusters(Z, center)
+        center = np.uint8(center)
+        result = center[label]
+        result2 = result.reshape(image.shape)
+        return result2
+
+
+def compute_colors(image_processed, positions):
+    colors = []
+    for pos in range(len(positions)):
+        color = image_processed[positions[pos][0], positions[pos][1]]
+        colors.append(color)
+    return colors
@@ -0,0 +1,33 @@
+class image_store:
+    """Images shared by the main window, the widgets and the worker thread, with a version
+    for each one. The images of the store are never modified, so they are passed without
+    copying them; a new image is stored when the data changes
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.versions = {}
+
+    def get(self, name):
+        return self.images.get(name)
+
+    def get_version(self, name):
+        return self.versions.get(name)
+
+    def put(self, name, image, version=None):
+        """Saves image, which must not be modified after this, and returns it. If version is
+        not given, the version is increased
+        """
+        if version is None:
+            version = self.versions.get(name, 0) + 1
+        self.images[name] = image
+        self.versions[name] = version
+        return image
+
+    def update(self, name, image, version):
+        """Returns a copy of image, which can be modified by its owner, and saves it. The copy
+        is only done when version is different from the one of the saved image
+        """
+        if name in self.images and self.versions[name] == version:
+            return self.images[name]
+        return self.put(name, image.copy(), version)
@@ -0,0 +1,51 @@
+from PySide6.QtCore import Qt, QPoint
+from PySide6.QtGui import QPainter, QColor, QPixmap
+
+# rings of the markers, from the outside to the inside, as (color, radius). None is the color
+# of the sample
+MARKER_RINGS = [('white', 10), ('black', 8), (None, 6)]
+MARKER_RINGS_DIFFERENCES = [('black', 12), (None, 8)]
+
+
+class marker_overlay:
+    """Transparent pixmap with the markers of the samples, which is painted over the image.
+    It is drawn again only when the lists of positions or colors, their lengths or the size
+    change, so the repaints do not depend on the number of samples
+    """
+
+    def __init__(self, rings):
+        self.rings = rings
+        self.pixmap = None
+        self.positions = None
+        self.colors = None
+        self.num_positions = -1
+        self.num_colors = -1
+
+    def draw(self, painter, positions, colors, size):
+        # the lists are kept, so they are compared by identity and not by value
+        if (self.pixmap is None or self.pixmap.size() != size or positions is not self.positions or colors is not self.colors
+                or len(positions) != self.num_positions or len(colors) != self.num_colors):
+            self.update(positions, colors, size)
+        painter.drawPixmap(0, 0, self.pixmap)
+
+    def update(self, positions, colors, size):
+        self.positions = positions
+        self.colors = colors
+        self.num_positions = len(positions)
+        self.num_colors = len(colors)
+
+        self.pixmap = QPixmap(size)
+        self.pixmap.fill(Qt.transparent)
+        painter = QPainter(self.pixmap)
+        painter.setRenderHint(QPainter.Antialiasing, False)
+        for pos in range(min(len(positions), len(colors))):
+            center = QPoint(int(positions[pos][1]), int(positions[pos][0]))
+            for name, radius in self.rings:
+                if name is None:
+                    color = QColor(int(colors[pos][0]), int(colors[pos][1]), int(colors[pos][2]))
+                else:
+                    color = QColor(name)
+                painter.setPen(color)
+                painter.setBrush(color)
+                painter.drawEllipse(center, radius, radius)
+        painter.end()
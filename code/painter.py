@@ -1,3 +1,8 @@
+import time
+
+# used to measure the startup time
+start_time = time.perf_counter()
+
 import math
 import os
 
@@ -16,15 +21,17 @@ from PySide6.QtWidgets import (
     QCheckBox,
     QRadioButton,
     QGroupBox,
+    QPushButton,
     QSlider,
     QSpinBox,
     QMessageBox,
     QComboBox,
     QLineEdit,
     QSizePolicy,
+    QProgressBar,
 )
 
-from PySide6.QtCore import Qt, Slot, QStandardPaths, Signal, QObject, QPoint, QDir, QSize
+from PySide6.QtCore import Qt, Slot, QStandardPaths, Signal, QObject, QPoint, QDir, QSize, QTimer
 
 from PySide6.QtGui import (
     QMouseEvent,
@@ -41,10 +48,14 @@ from PySide6.QtGui import (
     QCursor,
 )
 import sys
-import cv2
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 import globals
+from compute_worker import compute_signals, compute_job
+from image_store import image_store
+from threshold_curve_widget import threshold_curve_widget
 from painter_widget import painter_widget
 from painter_widget_mhd import painter_widget_mhd
 from painter_widget_differences import painter_widget_differences
@@ -76,6 +87,15 @@ class NumericLineEdit(QLineEdit):
     def setValue(self, value):
         self.setText(str(value))
 
+def get_max_threads():
+    # the same value as numba.config.NUMBA_NUM_THREADS, without loading numba
+    if 'NUMBA_NUM_THREADS' in os.environ:
+        return int(os.environ['NUMBA_NUM_THREADS'])
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
 class MainWindow(QMainWindow):
     """An Application example to draw using a pen """
 
@@ -170,6 +190,9 @@ class MainWindow(QMainWindow):
         action_save_image_with_positions = QAction(QApplication.style().standardIcon(QStyle.SP_DialogSaveButton), 'Save image with pos.', self)
         action_save_image_with_positions.triggered.connect(self.save_image_with_positions)
 
+        action_save_labels = QAction(QApplication.style().standardIcon(QStyle.SP_DialogSaveButton), 'Save label map', self)
+        action_save_labels.triggered.connect(self.save_labels)
+
         action_load_positions = QAction(QApplication.style().standardIcon(QStyle.SP_DialogOpenButton), 'Load positions', self)
         action_load_positions.triggered.connect(self.load_positions)
 
@@ -187,6 +210,7 @@ class MainWindow(QMainWindow):
         menu_file.addAction(action_save_image)
         menu_file.addAction(action_save_images)
         menu_file.addAction(action_save_image_with_positions)
+        menu_file.addAction(action_save_labels)
         menu_file.addSeparator()
         menu_file.addAction(action_load_positions)
         menu_file.addAction(action_save_positions)
@@ -251,6 +275,36 @@ class MainWindow(QMainWindow):
         self.mode_remove_positions = False
         self.mode_show_minimum_distance = False
 
+        # the computations are done in a worker thread. Only one job runs at a time, as they
+        # share the buffers of the widgets, and each update increases the generation so the
+        # jobs that are obsolete stop and their results are discarded
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.generation = 0
+        self.compute_job = None
+        self.compute_future = None
+        # generation of the last result shown in the widgets
+        self.applied_generation = -1
+        self.compute_signals = compute_signals()
+        self.compute_signals.stage.connect(self.compute_stage_changed)
+        self.compute_signals.preview.connect(self.painting_preview_computed)
+        self.compute_signals.finished.connect(self.painting_widgets_computed)
+        # images shared by the widgets and the jobs, without copies
+        self.images = image_store()
+        QApplication.instance().aboutToQuit.connect(self.stop_computations)
+
+        # the kernels are compiled in the worker thread before the first job, so the first
+        # computation does not stall
+        if globals.COMPILE_KERNELS_AT_STARTUP:
+            self.executor.submit(self.compile_kernels)
+
+        self.label_compute_stage = QLabel()
+        self.progressbar_compute = QProgressBar()
+        self.progressbar_compute.setRange(0, 0)
+        self.progressbar_compute.setMaximumWidth(150)
+        self.progressbar_compute.setVisible(False)
+        self.statusBar().addPermanentWidget(self.label_compute_stage)
+        self.statusBar().addPermanentWidget(self.progressbar_compute)
+
         # button = QMessageBox.information(self, "Information", "Adjust the size of the window to your needs before loading an image or painting in the canvas")
 
     def add_tab1(self):
@@ -299,12 +353,19 @@ class MainWindow(QMainWindow):
         checkbox_color_kmeans = QCheckBox()
         checkbox_color_kmeans.stateChanged.connect(self.change_compute_kmeans)
 
+        label_color_kmeans_subsample = QLabel('k-means subsample')
+        checkbox_color_kmeans_subsample = QCheckBox()
+        checkbox_color_kmeans_subsample.setChecked(globals.KMEANS_SUBSAMPLE)
+        checkbox_color_kmeans_subsample.stateChanged.connect(self.change_kmeans_subsample)
+
         gridlayout_color.addWidget(label_color_smooth, 0, 0)
         gridlayout_color.addWidget(combobox_color_smooth, 0, 1)
         gridlayout_color.addWidget(label_color_model, 1, 0)
         gridlayout_color.addWidget(combobox_color_model, 1, 1)
         gridlayout_color.addWidget(label_color_kmeans, 2, 0)
         gridlayout_color.addWidget(checkbox_color_kmeans, 2, 1)
+        gridlayout_color.addWidget(label_color_kmeans_subsample, 3, 0)
+        gridlayout_color.addWidget(checkbox_color_kmeans_subsample, 3, 1)
 
         groupbox_color.setLayout(gridlayout_color)
         #
@@ -398,6 +459,12 @@ class MainWindow(QMainWindow):
         tab2_spinbox_num_threshold.setValue(0)
         tab2_spinbox_num_threshold.valueChanged.connect(self.difference_threshold_changed)
 
+        tab2_label_num_threads = QLabel('Threads')
+        tab2_spinbox_num_threads = QSpinBox()
+        tab2_spinbox_num_threads.setRange(1, get_max_threads())
+        tab2_spinbox_num_threads.setValue(get_max_threads())
+        tab2_spinbox_num_threads.valueChanged.connect(self.num_threads_changed)
+
         tab2_gridlayout.addWidget(tab2_label_canvas_width, 0, 0)
         tab2_gridlayout.addWidget(self.tab2_numericlineedit_canvas_width,0, 1)
         tab2_gridlayout.addWidget(tab2_label_canvas_height, 1, 0)
@@ -409,11 +476,29 @@ class MainWindow(QMainWindow):
         tab2_gridlayout.addWidget(tab2_spinbox_num_clusters, 3, 1)
         tab2_gridlayout.addWidget(tab2_label_threshold, 4, 0)
         tab2_gridlayout.addWidget(tab2_spinbox_num_threshold, 4, 1)
+        tab2_gridlayout.addWidget(tab2_label_num_threads, 5, 0)
+        tab2_gridlayout.addWidget(tab2_spinbox_num_threads, 5, 1)
 
         tab2_aux_widget.setLayout(tab2_gridlayout)
 
+        # percentage of differences for all the thresholds
+        tab2_groupbox_curve = QGroupBox('Threshold curve')
+        tab2_layout_curve = QVBoxLayout()
+        self.threshold_curve = threshold_curve_widget()
+        tab2_button_compute_curve = QPushButton('Compute')
+        tab2_button_compute_curve.clicked.connect(self.compute_threshold_curve)
+        tab2_button_save_curve = QPushButton('Save')
+        tab2_button_save_curve.clicked.connect(self.save_threshold_curve)
+        tab2_layout_curve_buttons = QHBoxLayout()
+        tab2_layout_curve_buttons.addWidget(tab2_button_compute_curve)
+        tab2_layout_curve_buttons.addWidget(tab2_button_save_curve)
+        tab2_layout_curve.addWidget(self.threshold_curve)
+        tab2_layout_curve.addLayout(tab2_layout_curve_buttons)
+        tab2_groupbox_curve.setLayout(tab2_layout_curve)
+
         # Establece el layout en el widget
         tab2_layout.addWidget(tab2_aux_widget)
+        tab2_layout.addWidget(tab2_groupbox_curve)
         tab2_layout.addStretch()
 
         tab2_widget.setLayout(tab2_layout)
@@ -450,6 +535,8 @@ class MainWindow(QMainWindow):
         if dialog.exec() == QFileDialog.Accepted:
             if dialog.selectedFiles():
                 """ load pixmap from filename """
+                import cv2
+
                 image_bgr = cv2.imread(dialog.selectedFiles()[0])
                 self.image_width = self.canvas_width
                 self.image_height = int(self.image_width * image_bgr.shape[0] / image_bgr.shape[1])
@@ -539,10 +626,59 @@ class MainWindow(QMainWindow):
                         # read as x, y but added as y, x for numpy
                         self.painting_widget.positions.append([int(float(tokens[2])*(self.image_height-1)),int(float(tokens[1])*(self.image_width-1))])
 
-                    # self.painting_widget.update_colors()
+                    self.painting_widget.update_colors()
                     self.update_painting_widgets()
                     self.update()
 
+    @Slot()
+    def save_labels(self):
+        dialog = QFileDialog(self, "Save label map")
+        dialog.setAcceptMode(QFileDialog.AcceptSave)
+        dialog.setNameFilter("Numpy files (*.npy)")
+        dialog.setDefaultSuffix("npy")
+        dialog.setDirectory(QDir(os.getcwd() + '/data'))
+
+        if dialog.exec() == QFileDialog.Accepted:
+            if dialog.selectedFiles():
+                """ the index of the nearest sample of each pixel, and the squared distances """
+                # the labels must be the ones of the MHD image that is shown and current
+                if self.compute_mhd_value and self.applied_generation == self.generation and self.mhd_widget.save_labels(dialog.selectedFiles()[0], True):
+                    QMessageBox.information(self, 'Information', 'The file has been correctly saved')
+                else:
+                    QMessageBox.warning(self, 'Warning', 'The MHD image has not been computed')
+
+    @Slot()
+    def compute_threshold_curve(self):
+        # the distances of the last differences are used, so they must be computed and current.
+        # While a job runs they are obsolete, and the kernels must not run in two threads
+        percentages = None
+        if self.compute_differences_value and self.applied_generation == self.generation:
+            percentages = self.differences_widget.get_threshold_curve()
+        if percentages is None:
+            QMessageBox.warning(self, 'Warning', 'The differences have not been computed')
+        self.threshold_curve.set_curve(percentages)
+        return percentages
+
+    @Slot()
+    def save_threshold_curve(self):
+        percentages = self.compute_threshold_curve()
+        if percentages is None:
+            return
+
+        dialog = QFileDialog(self, "Save threshold curve")
+        dialog.setAcceptMode(QFileDialog.AcceptSave)
+        dialog.setNameFilter("CSV files (*.csv)")
+        dialog.setDefaultSuffix("csv")
+        dialog.setDirectory(QDir(os.getcwd() + '/data'))
+
+        if dialog.exec() == QFileDialog.Accepted:
+            if dialog.selectedFiles():
+                with open(dialog.selectedFiles()[0], mode='w', encoding='utf-8') as file:
+                    file.write('Threshold;Differences\n')
+                    for threshold in range(len(percentages)):
+                        file.write(str(threshold) + ';' + str(percentages[threshold]) + '\n')
+                QMessageBox.information(self, 'Information', 'The file has been correctly saved')
+
     @Slot()
     def save_positions(self,file_name):
         dialog = QFileDialog(self, "Save positions")
@@ -604,9 +740,22 @@ class MainWindow(QMainWindow):
     @Slot()
     def difference_threshold_changed(self, value):
         self.difference_threshold = value
+        self.threshold_curve.set_threshold(value)
+        # if the last result is the current one, only the threshold of its distances changes
+        if self.compute_differences_value and self.applied_generation == self.generation:
+            percentage = self.differences_widget.set_threshold(value)
+            if percentage is not None:
+                self.label_differences.setText('Differences ({:.2f}%)'.format(percentage))
+                return
         self.update_painting_widgets()
 
 
+    @Slot()
+    def num_threads_changed(self, value):
+        import fast_computation
+
+        fast_computation.set_num_threads(value)
+
     @Slot()
     def set_show_positions_w1(self, state):
         if state == Qt.Checked:
@@ -639,6 +788,14 @@ class MainWindow(QMainWindow):
             self.painting_widget.set_compute_kmeans(False)
         self.update_painting_widgets()
 
+    @Slot()
+    def change_kmeans_subsample(self, state):
+        if state == 2:
+            self.painting_widget.set_kmeans_subsample(True)
+        elif state == 0:
+            self.painting_widget.set_kmeans_subsample(False)
+        self.update_painting_widgets()
+
     @Slot()
     def change_compute_mhd_value(self, state):
         if state == 2: # enable
@@ -702,18 +859,117 @@ class MainWindow(QMainWindow):
 
     @Slot()
     def update_painting_widgets(self):
-        self.painting_widget.process_image()
+        self.generation += 1
+        # the previous job is not needed anymore if it has not started
+        if self.compute_future is not None:
+            self.compute_future.cancel()
+
+        # the painting is only copied when it has changed since the last job
+        image_rgb = self.images.update('rgb', self.painting_widget.image_rgb, self.painting_widget.image_version)
+        # the mask and the parameters of the preprocessing are copied, as the interface can
+        # change them while the job runs
+        job = compute_job(self.generation, self.get_generation, self.compute_signals, self.compute_painting_widgets,
+                          image_rgb, self.painting_widget.image_version, list(self.painting_widget.positions),
+                          self.compute_mhd_value, self.compute_differences_value, self.difference_threshold,
+                          self.mhd_widget.get_image_mhd(), list(self.mhd_parameters_values),
+                          self.painting_widget.get_processing_parameters())
+        self.progressbar_compute.setVisible(True)
+        self.compute_job = job
+        self.compute_future = self.executor.submit(job.run)
+
+    def get_generation(self):
+        return self.generation
+
+    def compile_kernels(self):
+        # numba and OpenCV are loaded here, after the window is shown
+        try:
+            import cv2
+            import fast_computation
+
+            print('Kernels compiled in {:.2f} s'.format(fast_computation.compile_kernels(globals.MHD_PARAMETERS)))
+        except Exception:
+            traceback.print_exc()
+
+    def stop_computations(self):
+        self.generation += 1
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def compute_painting_widgets(self, job, image_rgb, image_version, positions, compute_mhd_value, compute_differences_value, threshold, image_mhd, mhd_parameters_values, processing_parameters):
+        """Computes the images of the three widgets. It runs in the worker thread, so the
+        widgets are not modified here but in painting_widgets_computed
+        """
+        import fast_computation
+
+        job.report('Processing')
+        # image_rgb is not modified, so it is used as the processed image if there are no stages
+        image_processed = self.painting_widget.compute_processed_image(image_rgb, image_version, False, processing_parameters)
+        colors = self.painting_widget.compute_colors(image_processed, positions)
+        result = {'positions': positions, 'colors': colors, 'image_processed': image_processed,
+                  'cache_statistics': self.painting_widget.get_cache_statistics()}
+
+        # update the information for MHD. The differences are computed in the same pass
+        differences = None
+        if compute_mhd_value == True and len(positions)>0:
+            if job.is_cancelled():
+                return {}
+            job.report('MHD')
+            image_mhd, differences = self.mhd_widget.compute_image_mhd(positions, colors, image_processed, mhd_parameters_values, threshold if compute_differences_value else None, job.report_preview)
+            if image_mhd is None:
+                return {}
+            result['image_mhd'] = image_mhd
+            result['labels'] = self.mhd_widget.get_computed_labels()
+
+        if compute_differences_value == True:
+            if differences is None:
+                if job.is_cancelled():
+                    return {}
+                job.report('Differences')
+                differences = fast_computation.compute_differences(image_processed, image_mhd, threshold)
+            result['image_mhd_differences'] = image_mhd
+            result['differences'] = differences
+
+        return result
 
-        positions, colors, image_painting = self.painting_widget.get_values()
-        # update the information for MHD
-        if self.compute_mhd_value == True and len(positions)>0:
-            self.mhd_widget.set_values(positions, colors, image_painting)
-            self.mhd_widget.compute_mhd()
+    @Slot()
+    def compute_stage_changed(self, generation, stage):
+        if generation == self.generation:
+            self.label_compute_stage.setText(stage)
 
-        if self.compute_differences_value == True:
-            self.differences_widget.set_values(positions, colors, image_painting, self.mhd_widget.get_image_mhd(), self.difference_threshold)
-            percentage = self.differences_widget.compute_differences()
-            self.label_differences.setText('Differences ('+str(percentage)+'%)')
+    @Slot()
+    def painting_preview_computed(self, generation):
+        if generation == self.generation and self.compute_job.preview is not None:
+            image, step = self.compute_job.preview
+            self.mhd_widget.set_preview(image, step)
+
+    @Slot()
+    def painting_widgets_computed(self, generation):
+        if generation != self.generation:
+            return
+
+        self.progressbar_compute.setVisible(False)
+        self.label_compute_stage.setText('')
+        result = self.compute_job.result
+        if not result:
+            return
+
+        positions = result['positions']
+        colors = result['colors']
+        image_processed = self.images.put('processed', result['image_processed'])
+        self.painting_widget.set_processed_image(image_processed, colors)
+        self.statusBar().showMessage(result['cache_statistics'])
+
+        if 'image_mhd' in result:
+            self.mhd_widget.set_values(positions, colors, image_processed)
+            self.mhd_widget.set_image_mhd(self.images.put('mhd', result['image_mhd']))
+            self.mhd_widget.set_labels(*result['labels'])
+
+        if 'differences' in result:
+            differences, percentage = result['differences']
+            self.differences_widget.set_values(positions, colors, image_processed, result['image_mhd_differences'], self.difference_threshold)
+            self.differences_widget.set_differences(differences)
+            self.label_differences.setText('Differences ({:.2f}%)'.format(percentage))
+
+        self.applied_generation = generation
 
     @Slot()
     def on_clear(self):
@@ -797,4 +1053,5 @@ if __name__ == "__main__":
 
     w = MainWindow()
     w.show()
+    QTimer.singleShot(0, lambda: print('Window shown in {:.2f} s'.format(time.perf_counter() - start_time)))
     sys.exit(app.exec())
@@ -17,7 +17,7 @@ from PySide6.QtWidgets import (
     QRadioButton,
     QGroupBox,
 )
-from PySide6.QtCore import Qt, Slot, QStandardPaths, Signal, QObject, QPoint, QSize
+from PySide6.QtCore import Qt, Slot, QStandardPaths, Signal, QObject, QPoint, QSize, QRect
 
 from PySide6.QtGui import (
     QMouseEvent,
@@ -34,12 +34,14 @@ from PySide6.QtGui import (
 	QPixmap,
 )
 import sys
-import cv2
 import numpy as np
 
 import globals
 
-import fast_computation
+import image_processing
+from image_buffer import image_buffer
+from marker_overlay import marker_overlay, MARKER_RINGS
+from image_processing import image_processor
 
 contador = 0
 
@@ -58,10 +60,13 @@ class painter_widget(QWidget):
 
         self.image_rgb_size = QSize(self.height(), self.width())
 
-        self.pixmap = QPixmap(self.size())
-        self.pixmap.fill(Qt.white)
+        # the image shown in the widget
+        self.buffer = image_buffer(self.width(), self.height())
+        self.markers = marker_overlay(MARKER_RINGS)
         self.image_rgb = np.full((self.height(), self.width(), 3), 255, dtype=np.uint8)
         self.image_processed = np.full((self.height(), self.width(), 3), 255, dtype=np.uint8)
+        # it is increased each time image_rgb changes, and identifies it in the cache
+        self.image_version = 0
 
         self.previous_pos = None
 
@@ -82,15 +87,14 @@ class painter_widget(QWidget):
         self.brush_size = globals.BRUSH_SIZE_DEFAULT
         self.mhd_parameters_values = globals.MHD_PARAMETERS
 
-        self.color_model_smooth = 1
+        # structure to find the nearest sample in minimum mode. It is built again only when the
+        # key (versions of the image and the colors, number of positions and parameters) changes
+        self.colors_version = 0
+        self.minimum_query = None
+        self.minimum_query_key = None
+        self.minimum_pos = 0
 
-        self.color_model = 'RGB'
-        self.color_model_changed = False
-
-        # self.kmeans_computed = True
-        self.compute_kmeans_value = False
-        self.kmeans_num_clusters_value = globals.KMEANS_NUM_CLUSTERS
-        self.kmeans_num_iteractions_value = globals.KMEANS_NUM_ITERACTIONS
+        self.processor = image_processor()
 
         # connectios
         self.connections = []
@@ -110,77 +114,69 @@ class painter_widget(QWidget):
         self.image_rgb_size = image_size
 
     def reset_pixmap(self):
-        self.pixmap = QPixmap(self.image_rgb_size)
-        self.pixmap.fill(Qt.white)
+        self.buffer.fill(self.image_rgb_size.width(), self.image_rgb_size.height(), (255, 255, 255))
 
     def set_image(self, image):
         self.image_rgb = image.copy()
-
-    def get_values(self):
-        # self.update_colors()
-        return self.positions, self.colors, self.image_processed
+        self.image_version += 1
+        # used until the new image is processed. It is not copied, the buffer copies it if
+        # the brush is used
+        self.image_processed = self.image_rgb
 
     def resizeEvent(self, event):
         self.image_rgb = np.full((self.size().height(), self.size().width(), 3), 255, dtype=np.uint8)
-        self.convert_cv_mat_to_qt_pixmap(self.image_rgb, self.pixmap)
+        self.image_version += 1
+        self.buffer.set_image(self.image_rgb)
 
     def set_color_smooth(self, index):
-        if globals.COLOR_SMOOTH_KERNEL_SIZE[index] != self.color_model_smooth:
-            self.color_model_smooth = globals.COLOR_SMOOTH_KERNEL_SIZE[index]
+        if globals.COLOR_SMOOTH_KERNEL_SIZE[index] != self.processor.color_model_smooth:
+            self.processor.color_model_smooth = globals.COLOR_SMOOTH_KERNEL_SIZE[index]
 
     def set_color_model(self, index):
-        if globals.COLOR_MODELS[index] != self.color_model:
-            self.color_model = globals.COLOR_MODELS[index]
+        if globals.COLOR_MODELS[index] != self.processor.color_model:
+            self.processor.color_model = globals.COLOR_MODELS[index]
+
+    def set_hls_lightness_thresholds(self, low, high, middle):
+        self.processor.hls_lightness_low = low
+        self.processor.hls_lightness_high = high
+        self.processor.hls_lightness_middle = middle
 
     def set_compute_kmeans(self, value):
-        self.compute_kmeans_value = value
+        self.processor.compute_kmeans_value = value
 
     def set_kmeans_num_clusters_value(self, value):
-        self.kmeans_num_clusters_value = value
-
-    def process_image(self):
-        self.image_processed = self.image_rgb.copy()
-
-        if self.color_model_smooth>1:
-            self.image_processed = cv2.blur(self.image_processed, (self.color_model_smooth, self.color_model_smooth))
-
-        if self.color_model == 'HSV':
-            self.image_processed = cv2.cvtColor(self.image_processed, cv2.COLOR_RGB2HSV)
-        elif self.color_model == 'HLS':
-            self.image_processed = cv2.cvtColor(self.image_processed, cv2.COLOR_RGB2HLS)
-            self.image_processed[:, :, 2] = 255
-            for x in range(self.image_processed.shape[1]):
-                for y in range(self.image_processed.shape[0]):
-                    if self.image_processed[y, x, 1] < 10:
-                        self.image_processed[y, x, 1] = 0
-                    elif self.image_processed[y, x, 1] > 240:
-                        self.image_processed[y, x, 1] = 255
-                    else:
-                        self.image_processed[y, x, 1] = 128
-
-            self.image_processed = cv2.cvtColor(self.image_processed, cv2.COLOR_HLS2RGB)
-        # k-means
-        if self.compute_kmeans_value == True:
-            self.image_processed = self.k_means(self.image_processed, self.kmeans_num_clusters_value, self.kmeans_num_iteractions_value)
-
-        self.convert_cv_mat_to_qt_pixmap(self.image_processed, self.pixmap)
-        self.update_colors()
-        self.update()
+        self.processor.kmeans_num_clusters_value = value
 
+    def set_kmeans_subsample(self, value):
+        self.processor.kmeans_subsample_value = value
+
+    def compute_processed_image(self, image_rgb, image_version=None, copy=True, parameters=None):
+        """Applies the preprocessing to image_rgb and returns the result. It does not use Qt,
+        so it can be called from a worker thread with the parameters of get_processing_parameters
+        (see image_processor)
+        """
+        return self.processor.compute_processed_image(image_rgb, image_version, copy, parameters)
+
+    def get_processing_parameters(self):
+        return self.processor.get_parameters()
+
+    def get_cache_statistics(self):
+        return self.processor.get_cache_statistics()
+
+    def set_processed_image(self, image_processed, colors=None):
+        self.image_processed = image_processed
+        self.buffer.set_image(self.image_processed)
+        if colors is None:
+            self.update_colors()
+        else:
+            self.colors = colors
+            self.colors_version += 1
+        self.update()
 
     def paint(self, painter):
-        # Dibuja un círculo
+        # the markers are drawn in a pixmap that is reused while the positions do not change
         if self.show_positions_value:
-            for pos in range(len(self.positions)):
-                painter.setPen(QColor("white"))  # Color del borde
-                painter.setBrush(QColor("white"))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1], self.positions[pos][0]), 10, 10)
-                painter.setPen(QColor("black"))  # Color del borde
-                painter.setBrush(QColor("black"))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1],self.positions[pos][0]), 8, 8)
-                painter.setPen(QColor(self.colors[pos][0],self.colors[pos][1], self.colors[pos][2]))  # Color del borde
-                painter.setBrush(QColor(self.colors[pos][0],self.colors[pos][1], self.colors[pos][2]))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1],self.positions[pos][0]), 6, 6)
+            self.markers.draw(painter, self.positions, self.colors, self.size())
 
         pen1 = QPen(QColor('black'), 1)
         painter.setPen(pen1)
@@ -194,7 +190,7 @@ class painter_widget(QWidget):
     def paintEvent(self, event: QPaintEvent):
         painter = QPainter(self)
         painter.setRenderHint(QPainter.Antialiasing, False)
-        painter.drawPixmap(0, 0, self.pixmap)
+        self.buffer.draw(painter)
         self.paint(painter)
 
     def mousePressEvent(self, event: QMouseEvent):
@@ -205,6 +201,9 @@ class painter_widget(QWidget):
             self.end_position = event.position().toPoint()
 
         self.previous_pos = event.position().toPoint()
+        if self.mode == globals.MODE_DRAW and event.buttons() & Qt.MouseButton.LeftButton:
+            self.start_stroke()
+            self.draw_stroke(self.previous_pos, self.previous_pos)
         QWidget.mousePressEvent(self, event)
 
     def mouseMoveEvent(self, event: QMouseEvent):
@@ -214,8 +213,15 @@ class painter_widget(QWidget):
         if self.mode == globals.MODE_DRAW:
             if event.buttons() & Qt.MouseButton.LeftButton:
                 current_pos = event.position().toPoint()
-                cv2.circle(self.image_rgb, (current_pos.x(), current_pos.y()), int(self.brush_size/2), self.brush_color, -1)
-                self.convert_cv_mat_to_qt_pixmap(self.image_rgb, self.pixmap)
+                if self.previous_pos is None:
+                    self.previous_pos = current_pos
+                    self.start_stroke()
+                # only the rectangle of the stroke is repainted
+                rect = self.draw_stroke(self.previous_pos, current_pos)
+                self.previous_pos = current_pos
+                QWidget.mouseMoveEvent(self, event)
+                self.update(rect)
+                return
         elif self.mode == globals.MODE_MINIMUM and event.buttons():
                 self.end_position = event.position().toPoint()
                 self.compute_mhd()
@@ -223,6 +229,40 @@ class painter_widget(QWidget):
         QWidget.mouseMoveEvent(self, event)
         self.update()
 
+    def start_stroke(self):
+        # the strokes are drawn in image_rgb, so it is shown without the preprocessing until the
+        # painting is processed again, when the mouse is released. The buffer uses the memory of
+        # image_rgb, so it is not copied and the strokes are shown without writing them
+        if self.buffer.image is not self.image_rgb:
+            self.buffer.set_image(self.image_rgb)
+            self.update()
+
+    def draw_stroke(self, start, end):
+        """Draws a line with the brush from start to end in image_rgb, so no stroke is lost when
+        the mouse moves fast. Returns the rectangle that has changed
+        """
+        import cv2
+
+        # the processed image may have been shown while drawing
+        self.start_stroke()
+
+        radius = int(self.brush_size/2)
+        if start == end:
+            cv2.circle(self.image_rgb, (start.x(), start.y()), radius, self.brush_color, -1)
+        else:
+            # the ends of the thick lines are round, and with this thickness the line is as wide
+            # as the circles of the brush (2*radius + 1 pixels). OpenCV needs at least 1
+            cv2.line(self.image_rgb, (start.x(), start.y()), (end.x(), end.y()), self.brush_color, max(1, 2*radius))
+        self.image_version += 1
+
+        x0 = max(min(start.x(), end.x()) - radius - 1, 0)
+        y0 = max(min(start.y(), end.y()) - radius - 1, 0)
+        x1 = min(max(start.x(), end.x()) + radius + 2, self.image_rgb.shape[1])
+        y1 = min(max(start.y(), end.y()) + radius + 2, self.image_rgb.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return QRect()
+        return QRect(x0, y0, x1 - x0, y1 - y0)
+
     def mouseReleaseEvent(self, event: QMouseEvent):
         """Override method from QWidget
         Called when user releases the mouse
@@ -237,7 +277,9 @@ class painter_widget(QWidget):
             self.start_position = None
 
         self.previous_pos = None
-        self.process_image()
+        # the colors are updated now so they match the positions until the image is processed again
+        self.update_colors()
+        self.update()
         self.my_released.emit()
 
     def keyReleaseEvent(self, event):
@@ -264,34 +306,11 @@ class painter_widget(QWidget):
             del self.positions[positions[0]]
 
 
-    # def convert_qt_pixmap_to_cv_mat(self, pixmap):
-    #     print("pix to map")
-    #     qt_image = pixmap.toImage()
-    #     qt_image = qt_image.convertToFormat(QImage.Format.Format_RGB888)
-    #     # version que falla
-    #     # np_array = np.array(self.qt_image.constBits(), copy=False).reshape(self.qt_image.height(), self.qt_image.width(), 3)
-    #     # version correcta
-    #     # https://gallois.cc/blog/qimage/
-    #     np_array = np.ndarray((qt_image.height(), qt_image.width(), 3), buffer=qt_image.constBits(),strides=[qt_image.bytesPerLine(), 3, 1], dtype=np.uint8)
-    #     return np_array
-
-    def convert_qt_pixmap_to_cv_mat(self, pixmap, image):
-        qt_image = pixmap.toImage().convertToFormat(QImage.Format_RGB888)
-        del image
-        image = np.ndarray((qt_image.height(), qt_image.width(), 3), buffer=qt_image.constBits(),
-                           strides=[qt_image.bytesPerLine(), 3, 1], dtype=np.uint8)
-
-    def convert_cv_mat_to_qt_pixmap(self, image, pixmap):
-        """Convertir de una imagen de OpenCV a QPixmap"""
-        pixmap.convertFromImage(QImage(image.data, image.shape[1], image.shape[0], image.strides[0], QImage.Format.Format_RGB888))
-
     def get_color(self,position):
-        qt_image = self.pixmap.toImage()
-        color = qt_image.pixelColor(position)
-        return [color.red(), color.green(), color.blue(), 255]
+        return self.buffer.get_color(position.x(), position.y())
 
     def get_pixmap(self):
-        pixmap_result = QPixmap(self.pixmap)
+        pixmap_result = self.buffer.get_pixmap()
         painter = QPainter(pixmap_result)
         painter.setRenderHint(QPainter.Antialiasing, False)
         # painter.drawPixmap(0, 0, self.pixmap)
@@ -300,7 +319,7 @@ class painter_widget(QWidget):
 
     def clear(self):
         """ Clear the pixmap """
-        self.pixmap.fill(Qt.white)
+        self.buffer.fill(self.buffer.image.shape[1], self.buffer.image.shape[0], (255, 255, 255))
         self.positions.clear()
         self.colors.clear()
         self.update()
@@ -324,42 +343,40 @@ class painter_widget(QWidget):
         self.brush_color = color
 
     def compute_mhd(self):
+        import fast_computation
+
         if len(self.positions)>0:
-            positions = np.array(self.positions)
-            colors = np.array(self.colors)
-            pos_min = fast_computation.compute_mhd_one_position(positions, colors, self.image_rgb, self.mhd_parameters_values, self.end_position.x(), self.end_position.y())
-            self.start_position =  QPoint(self.positions[pos_min][1], self.positions[pos_min][0])
+            key = (self.image_version, self.colors_version, len(self.positions), tuple(self.mhd_parameters_values))
+            if key != self.minimum_query_key:
+                positions = np.array(self.positions)
+                colors = np.array(self.colors)
+                self.minimum_query = fast_computation.build_mhd_query(positions, colors, self.image_rgb.shape, self.mhd_parameters_values)
+                self.minimum_query_key = key
+                self.minimum_pos = 0
+
+            # the mouse can be dragged outside the image
+            x = min(max(self.end_position.x(), 0), self.image_rgb.shape[1]-1)
+            y = min(max(self.end_position.y(), 0), self.image_rgb.shape[0]-1)
+            self.minimum_pos = fast_computation.compute_mhd_position(self.minimum_query, self.image_rgb, x, y, self.minimum_pos)
+            self.start_position =  QPoint(self.positions[self.minimum_pos][1], self.positions[self.minimum_pos][0])
 
     def update_colors(self):
-        self.colors = []
-        for pos in range(len(self.positions)):
-            color = self.image_processed[self.positions[pos][0], self.positions[pos][1]]
-            self.colors.append(color)
-
+        self.colors = self.compute_colors(self.image_processed, self.positions)
+        self.colors_version += 1
 
-    def k_means(self, image, num_clusters, num_iteractions):
-        Z = image.reshape((-1, 3))
-        # # convert to np.float32
-        Z = np.float32(Z)
-        # define criteria, number of clusters(K) and apply kmeans()
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, num_iteractions, 1.0)
-        ret, label, center = cv2.kmeans(Z, num_clusters, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
-        # Now convert back into uint8, and make original image
-        center = np.uint8(center)
-        result = center[label.flatten()]
-        result2 = result.reshape(image.shape)
-        return result2
+    def compute_colors(self, image_processed, positions):
+        return image_processing.compute_colors(image_processed, positions)
 
 
     def paint_positions(self):
         # Crear un QPixmap del tamaño de la imagen original
-        result_image = QPixmap(self.pixmap.size())
+        result_image = QPixmap(self.buffer.get_size())
         result_image.fill(Qt.transparent)  # Llenar con transparencia
 
         # Crear un QPainter para dibujar en el QPixmap
         painter = QPainter(result_image)
         painter.setRenderHint(QPainter.Antialiasing, False)
-        painter.drawPixmap(0, 0, self.pixmap)
+        self.buffer.draw(painter)
         self.paint(painter)
 
         painter.end()
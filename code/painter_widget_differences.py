@@ -14,10 +14,9 @@ import sys
 import numpy as np
 
 import globals
+from image_buffer import image_buffer
+from marker_overlay import marker_overlay, MARKER_RINGS_DIFFERENCES
 
-import fast_computation
-
-from copy import deepcopy
 
 class painter_widget_differences(QWidget):
     """A widget where user can draw with their mouse
@@ -35,8 +34,8 @@ class painter_widget_differences(QWidget):
         self.image_original = np.zeros((self.height(), self.width(), 3), dtype=np.uint8)
         self.image_mhd = np.zeros((self.height(), self.width(), 3), dtype=np.uint8)
 
-        self.pixmap = QPixmap(self.image_size)
-        self.pixmap.fill(Qt.white)
+        self.buffer = image_buffer(self.image_size.width(), self.image_size.height())
+        self.markers = marker_overlay(MARKER_RINGS_DIFFERENCES)
 
         self.positions = []
         self.colors = []
@@ -46,6 +45,12 @@ class painter_widget_differences(QWidget):
         self.show_positions_value = False
         self.compute_differences_value = False
 
+        # squared color distance of each pixel and the cumulative counts of the distances, used
+        # to change the threshold without computing the differences again
+        self.values_set = False
+        self.color_distances = None
+        self.distance_counts = None
+
     def set_size(self, width, height):
         margins = self.contentsMargins()
         margin_width = margins.left() + margins.right()
@@ -56,16 +61,15 @@ class painter_widget_differences(QWidget):
         self.image_size = image_size
         self.image_original = np.full((self.image_size.height(), self.image_size.width(), 3), 255, dtype=np.uint8)
         self.image_mhd = np.full((self.image_size.height(), self.image_size.width(), 3), 255, dtype=np.uint8)
-        self.convert_cv_mat_to_qt_pixmap(self.image_original, self.pixmap)
+        self.values_set = False
+        self.buffer.set_image(self.image_original)
         self.update()
 
     def reset_pixmap(self):
-        self.pixmap = QPixmap(self.image_size)
-        self.pixmap.fill(Qt.white)
+        self.buffer.fill(self.image_size.width(), self.image_size.height(), (255, 255, 255))
 
     def resizeEvent(self, event):
-        self.pixmap = QPixmap(self.size())
-        self.pixmap.fill(Qt.white)
+        self.buffer.fill(self.width(), self.height(), (255, 255, 255))
         self.update()
 
     def set_compute_differences_value(self, value):
@@ -80,43 +84,69 @@ class painter_widget_differences(QWidget):
         """
         painter = QPainter(self)
         painter.setRenderHint(QPainter.Antialiasing, False)
-        painter.drawPixmap(0, 0, self.pixmap)
+        self.buffer.draw(painter)
 
-        # Dibuja un círculo
         if self.show_positions_value:
-            for pos in range(len(self.positions)):
-                painter.setPen(QColor("black"))  # Color del borde
-                painter.setBrush(QColor("black"))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1], self.positions[pos][0]), 12, 12)
-                painter.setPen(QColor(self.colors[pos][0], self.colors[pos][1], self.colors[pos][2]))  # Color del borde
-                painter.setBrush(
-                    QColor(self.colors[pos][0], self.colors[pos][1], self.colors[pos][2]))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1], self.positions[pos][0]), 8, 8)
+            self.markers.draw(painter, self.positions, self.colors, self.size())
 
     def set_values(self, positions, colors, image_original, image_mhd, threshold):
         self.positions = positions
         self.colors = colors
-        self.image_original = deepcopy(image_original)
-        self.image_mhd = deepcopy(image_mhd)
+        # the images are shared with the main window and they are not modified
+        self.image_original = image_original
+        self.image_mhd = image_mhd
+        self.threshold = threshold
+        self.values_set = True
+        self.color_distances = None
+        self.distance_counts = None
+
+    def set_threshold(self, threshold):
+        """Computes the differences for a new threshold from the distances of the pixels, which
+        are computed the first time. Returns the percentage, or None if there are no values
+        """
+        import fast_computation
+
+        if not self.compute_color_distances():
+            return None
+
         self.threshold = threshold
+        self.set_differences(fast_computation.threshold_color_distances(self.color_distances, fast_computation.get_threshold_squared(threshold)))
+        return fast_computation.get_differences_percentage(self.distance_counts, threshold)
 
-    def compute_differences(self):
-        if self.compute_differences_value == True:
-            result, percentage = fast_computation.compute_differences(self.image_original, self.image_mhd, self.threshold)
-            self.convert_cv_mat_to_qt_pixmap(result, self.pixmap)
+    def compute_color_distances(self):
+        # returns False if there are no values. It is called before the other kernels of this
+        # widget, so it applies the number of threads, which numba keeps per calling thread
+        import numba
+        import fast_computation
+
+        if not self.values_set or self.image_original.shape != self.image_mhd.shape:
+            return False
+
+        numba.set_num_threads(fast_computation.num_threads)
+
+        if self.color_distances is None:
+            self.color_distances = fast_computation.compute_color_distances(self.image_original, self.image_mhd)
+            self.distance_counts = fast_computation.compute_distance_counts(self.color_distances)
+        return True
+
+    def get_threshold_curve(self):
+        """Returns the percentage of differences for each threshold (0-100%), or None"""
+        import fast_computation
+
+        if not self.compute_color_distances():
+            return None
+        return fast_computation.compute_threshold_curve(self.distance_counts)
+
+    def set_differences(self, result):
+        if result is not None:
+            self.buffer.set_image(result)
         else:
-            percentage = 100
             self.reset_pixmap()
 
         self.update()
-        return percentage
-
-    def convert_cv_mat_to_qt_pixmap(self, image, pixmap):
-        """Convertir de una imagen de OpenCV a QPixmap"""
-        pixmap.convertFromImage(QImage(image.data, image.shape[1], image.shape[0], image.strides[0], QImage.Format.Format_RGB888))
 
     def get_differences_pixmap(self):
-        return self.pixmap
+        return self.buffer.get_pixmap()
 
     @Slot()
     def set_show_positions(self, state):
@@ -124,4 +154,4 @@ class painter_widget_differences(QWidget):
         self.update()
 
     def get_pixmap(self):
-        return self.pixmap
\ No newline at end of file
+        return self.buffer.get_pixmap()
\ No newline at end of file
@@ -15,6 +15,7 @@ from PySide6.QtWidgets import (
     QCheckBox,
     QRadioButton,
     QGroupBox,
+    QToolTip,
 )
 from PySide6.QtCore import Qt, Slot, QStandardPaths, Signal, QObject, QPoint, QSize
 
@@ -32,15 +33,14 @@ from PySide6.QtGui import (
 	QImage,
 	QPixmap,
 )
+import os
 import sys
-import cv2
 import numpy as np
 
 import globals
+from image_buffer import image_buffer
+from marker_overlay import marker_overlay, MARKER_RINGS
 
-import fast_computation
-
-from copy import deepcopy
 
 class painter_widget_mhd(QWidget):
     """A widget where user can draw with their mouse
@@ -60,8 +60,8 @@ class painter_widget_mhd(QWidget):
 
         self.image_mhd = np.zeros((self.height(), self.width(), 3), dtype=np.uint8)
 
-        self.pixmap = QPixmap(self.size())
-        self.pixmap.fill(Qt.blue)
+        self.buffer = image_buffer(self.width(), self.height(), (0, 0, 255))
+        self.markers = marker_overlay(MARKER_RINGS)
 
         self.positions = []
         self.colors = []
@@ -70,6 +70,26 @@ class painter_widget_mhd(QWidget):
         self.compute_mhd_value = False
 
         self. mhd_parameters_values = globals.MHD_PARAMETERS
+        self.use_index = globals.MHD_USE_INDEX
+
+        # nearest sample and squared distance of each pixel, and the values used to compute
+        # them. They allow to update only the affected pixels when a position is added or removed
+        self.labels = None
+        self.distances = None
+        self.labels_positions = None
+        self.labels_colors = None
+        self.labels_image = None
+        self.labels_mhd_parameters = None
+        # number of pixels of each sample
+        self.areas = None
+        # the labels, distances and areas of the MHD image that is shown. The worker thread
+        # does not modify them, so they are used by the tooltip and to save the label map
+        self.shown_labels = None
+        self.shown_distances = None
+        self.shown_areas = None
+
+        # the sample under the mouse is shown in a tooltip
+        self.setMouseTracking(True)
 
     def set_size(self, width, height):
         margins = self.contentsMargins()
@@ -82,26 +102,28 @@ class painter_widget_mhd(QWidget):
         self.image = np.zeros((self.image_size.height(), self.image_size.width(), 3), dtype=np.uint8)
         self.image[:, :, 2] = 255
         self.image_mhd = np.zeros((self.image_size.height(), self.image_size.width(), 3), dtype=np.uint8)
-        self.convert_cv_mat_to_qt_pixmap(self.image, self.pixmap)
+        self.buffer.set_image(self.image)
         self.update()
 
     def set_values(self,positions, colors, image):
         self.positions = positions
         self.colors = colors
-        self.image = deepcopy(image)
+        # the images are shared with the main window and they are not modified
+        self.image = image
 
     def set_compute_mhd_value(self, value):
         self.compute_mhd_value = value
         if value == False:
+            self.set_labels(None, None, None)
             self.compute_mhd()
         self.update()
 
     def get_image_mhd(self):
-        return self.image_mhd.copy()
+        # it must not be modified
+        return self.image_mhd
 
     def resizeEvent(self, event):
-        self.pixmap = QPixmap(self.size())
-        self.pixmap.fill(Qt.blue)
+        self.buffer.fill(self.width(), self.height(), (0, 0, 255))
         self.update()
 
     def paintEvent(self, event: QPaintEvent):
@@ -110,38 +132,180 @@ class painter_widget_mhd(QWidget):
         """
         painter = QPainter(self)
         painter.setRenderHint(QPainter.Antialiasing, False)
-        painter.drawPixmap(0, 0, self.pixmap)
+        self.buffer.draw(painter)
 
-        # Dibuja un círculo
         if self.show_positions_value:
-            for pos in range(len(self.positions)):
-                painter.setPen(QColor("white"))  # Color del borde
-                painter.setBrush(QColor("white"))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1], self.positions[pos][0]), 10, 10)
-                painter.setPen(QColor("black"))  # Color del borde
-                painter.setBrush(QColor("black"))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1], self.positions[pos][0]), 8, 8)
-                painter.setPen(QColor(self.colors[pos][0], self.colors[pos][1], self.colors[pos][2]))  # Color del borde
-                painter.setBrush(QColor(self.colors[pos][0], self.colors[pos][1], self.colors[pos][2]))  # Color de relleno
-                painter.drawEllipse(QPoint(self.positions[pos][1], self.positions[pos][0]), 6, 6)
+            self.markers.draw(painter, self.positions, self.colors, self.size())
 
     def compute_mhd(self):
         if self.compute_mhd_value == True:
-            positions = np.array(self.positions)
-            colors = np.array(self.colors)
-            del self.image_mhd
-            self.image_mhd = fast_computation.compute_mhd(positions, colors, self.image, self.mhd_parameters_values)
+            image_mhd, differences = self.compute_image_mhd(self.positions, self.colors, self.image, list(self.mhd_parameters_values))
+            self.set_labels(*self.get_computed_labels())
+        else:
+            image_mhd = None
+        self.set_image_mhd(image_mhd)
+
+    def compute_image_mhd(self, positions, colors, image, mhd_parameters_values, threshold=None, preview=None):
+        """Returns the MHD image and, if threshold is given, the differences with image and the
+        percentage (or None). Only the buffers of the labels are modified, so it can be called
+        from a worker thread while the widget is painted. mhd_parameters_values must be a copy
+        that is not changed during the computation, as it is saved with the labels.
+        If preview is given and the image is large, preview(image, step) is called with coarse
+        MHD images before the final one; if it returns False, (None, None) is returned
+        """
+        import fast_computation
+
+        positions = np.array(positions)
+        colors = np.array(colors)
+        differences = None
+        change, index = self.find_change(positions, colors, image, mhd_parameters_values)
+        if change in ('add', 'remove'):
+            # the labels that are shown are not modified, the update is done in a copy
+            self.labels = self.labels.copy()
+            self.distances = self.distances.copy()
+        if change == 'add':
+            fast_computation.add_mhd_position(positions, colors, image, mhd_parameters_values, self.labels, self.distances, index, globals.MHD_TILE_SIZE)
+        elif change == 'remove':
+            fast_computation.remove_mhd_position(positions, colors, image, mhd_parameters_values, self.labels, self.distances, index, globals.MHD_TILE_SIZE)
+        elif change == 'all' and preview is not None and self.use_index and globals.MHD_PROGRESSIVE and image.shape[0] * image.shape[1] > globals.MHD_PROGRESSIVE_MIN_PIXELS:
+            # the last level computes the differences in the same pass, as compute_mhd_differences
+            result = fast_computation.compute_mhd_labels_progressive(positions, colors, image, mhd_parameters_values, globals.MHD_PREVIEW_PIXELS,
+                                                                     lambda labels, step: preview(colors[labels], step), threshold, globals.MHD_TILE_SIZE)
+            if result is None:
+                return None, None
+            if threshold is None:
+                self.labels, self.distances = result
+            else:
+                self.labels, self.distances, image_mhd, mask, percentage = result
+                differences = (mask, percentage)
+        elif change == 'all' and threshold is not None:
+            # the labels and the differences in the same pass
+            self.labels, self.distances, image_mhd, mask, percentage = fast_computation.compute_mhd_differences(positions, colors, image, mhd_parameters_values, threshold, self.use_index, globals.MHD_TILE_SIZE)
+            differences = (mask, percentage)
+        elif change == 'all':
+            self.labels, self.distances = fast_computation.compute_mhd_labels(positions, colors, image, mhd_parameters_values, self.use_index, globals.MHD_TILE_SIZE)
+
+        self.labels_positions = positions
+        self.labels_colors = colors
+        self.labels_image = image
+        self.labels_mhd_parameters = mhd_parameters_values
+        self.areas = self.compute_areas()
+
+        if differences is None:
+            if threshold is None:
+                image_mhd = fast_computation.compute_mhd_image(self.labels, colors, image)
+            else:
+                image_mhd, mask, percentage = fast_computation.compute_mhd_image(self.labels, colors, image, threshold, globals.MHD_TILE_SIZE)
+                differences = (mask, percentage)
+
+        return image_mhd, differences
+
+    def set_preview(self, image, step):
+        # only the buffer changes, each pixel of image is painted as step x step pixels
+        self.buffer.set_image(image, step)
+        self.update()
+
+    def set_image_mhd(self, image_mhd):
+        del self.image_mhd
+        if image_mhd is not None:
+            self.image_mhd = image_mhd
         else:
-            del self.image_mhd
             self.image_mhd = np.zeros((self.height(), self.width(), 3), dtype=np.uint8)
             self.image_mhd[:, :, 2] = 255
 
-        self.convert_cv_mat_to_qt_pixmap(self.image_mhd, self.pixmap)
+        self.buffer.set_image(self.image_mhd)
         self.update()
 
-    def convert_cv_mat_to_qt_pixmap(self, image, pixmap):
-        """Convertir de una imagen de OpenCV a QPixmap"""
-        pixmap.convertFromImage(QImage(image.data, image.shape[1], image.shape[0], image.strides[0], QImage.Format.Format_RGB888))
+    def get_computed_labels(self):
+        # the labels, distances and areas of the last compute_image_mhd, for set_labels
+        return self.labels, self.distances, self.areas
+
+    def set_labels(self, labels, distances, areas):
+        """Saves the labels of the MHD image that is shown (see get_computed_labels)"""
+        self.shown_labels = labels
+        self.shown_distances = distances
+        self.shown_areas = areas
+
+    def get_labels(self):
+        """Returns the index of the nearest sample of each pixel (int32) of the MHD image that
+        is shown, or None. It must not be modified
+        """
+        return self.shown_labels
+
+    def get_distances(self):
+        """Returns the squared distance of each pixel to its nearest sample (float32), or None"""
+        return self.shown_distances
+
+    def get_label(self, x, y):
+        # -1 if there are no labels or the pixel is outside the image
+        if self.shown_labels is None or x < 0 or y < 0 or y >= self.shown_labels.shape[0] or x >= self.shown_labels.shape[1]:
+            return -1
+        return int(self.shown_labels[y, x])
+
+    def compute_areas(self):
+        """Returns the number of pixels whose nearest sample is each sample"""
+        if self.labels is None:
+            return None
+        return np.bincount(self.labels.ravel(), minlength=len(self.labels_positions))
+
+    def save_labels(self, file_name, save_distances=False):
+        """Saves the labels as a .npy file, and the distances in a file with the suffix
+        _distances. Returns False if there are no labels
+        """
+        if self.shown_labels is None:
+            return False
+        np.save(file_name, self.shown_labels)
+        if save_distances:
+            np.save(os.path.splitext(file_name)[0] + '_distances.npy', self.shown_distances)
+        return True
+
+    def mouseMoveEvent(self, event: QMouseEvent):
+        position = event.position().toPoint()
+        label = self.get_label(position.x(), position.y()) if self.compute_mhd_value else -1
+        if label >= 0 and self.shown_areas is not None and label < len(self.shown_areas):
+            area = 100.0 * self.shown_areas[label] / self.shown_labels.size
+            distance = math.sqrt(self.shown_distances[position.y(), position.x()])
+            QToolTip.showText(event.globalPosition().toPoint(), 'Sample {}\nArea {:.2f}%\nDistance {:.3f}'.format(label + 1, area, distance), self)
+        else:
+            QToolTip.hideText()
+        QWidget.mouseMoveEvent(self, event)
+
+    def find_change(self, positions, colors, image, mhd_parameters_values):
+        """Compares the samples with the ones used to compute the labels.
+        Returns ('none', -1) if nothing has changed, ('add', index) or ('remove', index) if only
+        one sample has been inserted or deleted, and ('all', -1) otherwise
+        """
+        if self.labels is None or not self.use_index:
+            return 'all', -1
+        if self.labels_mhd_parameters != list(mhd_parameters_values):
+            return 'all', -1
+        if self.labels_image is not image and not np.array_equal(self.labels_image, image):
+            return 'all', -1
+
+        old_positions = self.labels_positions
+        old_colors = self.labels_colors
+        if len(positions) == len(old_positions):
+            if np.array_equal(positions, old_positions) and np.array_equal(colors, old_colors):
+                return 'none', -1
+            return 'all', -1
+
+        if len(positions) == len(old_positions) + 1:
+            change = 'add'
+            longer_positions, longer_colors, shorter_positions, shorter_colors = positions, colors, old_positions, old_colors
+        elif len(positions) == len(old_positions) - 1:
+            change = 'remove'
+            longer_positions, longer_colors, shorter_positions, shorter_colors = old_positions, old_colors, positions, colors
+        else:
+            return 'all', -1
+
+        # the first sample that is different is the inserted or deleted one
+        different = np.flatnonzero(np.any(longer_positions[:-1] != shorter_positions, axis=1) | np.any(longer_colors[:-1] != shorter_colors, axis=1))
+        index = different[0] if len(different) > 0 else len(shorter_positions)
+
+        if not (np.array_equal(np.delete(longer_positions, index, axis=0), shorter_positions) and np.array_equal(np.delete(longer_colors, index, axis=0), shorter_colors)):
+            return 'all', -1
+
+        return change, int(index)
 
     @Slot()
     def set_show_positions(self, state):
@@ -154,4 +318,4 @@ class painter_widget_mhd(QWidget):
 
 
     def get_pixmap(self):
-        return self.pixmap
\ No newline at end of file
+        return self.buffer.get_pixmap()
\ No newline at end of file
@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+
+class stage_cache:
+    """LRU cache for the images produced by the stages of the preprocessing.
+    The keys are tuples with the name of the stage, the version of the input image and the
+    parameters of the stages applied; the least recently used images are removed when the
+    memory used is greater than max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, image):
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key).nbytes
+
+        if image.nbytes > self.max_bytes:
+            return
+
+        self.entries[key] = image
+        self.num_bytes += image.nbytes
+        while self.num_bytes > self.max_bytes:
+            key_removed, image_removed = self.entries.popitem(last=False)
+            self.num_bytes -= image_removed.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def get_statistics(self):
+        return 'Cache: {} hits, {} misses, {:.1f} MB'.format(self.hits, self.misses, self.num_bytes / (1024 * 1024))
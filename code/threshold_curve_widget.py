@@ -0,0 +1,52 @@
+from PySide6.QtWidgets import QWidget
+from PySide6.QtCore import Qt, QPointF, QRectF
+from PySide6.QtGui import QPaintEvent, QPainter, QPen, QColor, QPolygonF
+
+
+class threshold_curve_widget(QWidget):
+    """Plot of the percentage of differences for each threshold (0-100%).
+    The current threshold is marked with a vertical line
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        self.setMinimumHeight(150)
+
+        self.percentages = None
+        self.threshold = 0
+
+    def set_curve(self, percentages):
+        self.percentages = percentages
+        self.update()
+
+    def set_threshold(self, threshold):
+        self.threshold = threshold
+        self.update()
+
+    def paintEvent(self, event: QPaintEvent):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor('white'))
+
+        margin = 4
+        area = QRectF(margin, margin, self.width() - 2 * margin, self.height() - 2 * margin)
+        painter.setPen(QPen(QColor('black'), 1))
+        painter.drawRect(area)
+
+        if self.percentages is None or len(self.percentages) < 2:
+            painter.drawText(area, Qt.AlignCenter, 'No curve')
+            return
+
+        last = len(self.percentages) - 1
+        x = area.left() + area.width() * self.threshold / last
+        painter.setPen(QPen(QColor('gray'), 1, Qt.DashLine))
+        painter.drawLine(QPointF(x, area.top()), QPointF(x, area.bottom()))
+
+        curve = QPolygonF()
+        for threshold, percentage in enumerate(self.percentages):
+            curve.append(QPointF(area.left() + area.width() * threshold / last, area.bottom() - area.height() * percentage / 100.0))
+        painter.setPen(QPen(QColor('red'), 2))
+        painter.drawPolyline(curve)
+
+        painter.setPen(QPen(QColor('black'), 1))
+        painter.drawText(area.adjusted(4, 2, -4, -2), Qt.AlignRight | Qt.AlignTop, '{:.2f}%'.format(self.percentages[min(self.threshold, last)]))